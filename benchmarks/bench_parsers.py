@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Benchmark the per-file cost of parsing CAMB outputs with the fast parser vs. numpy.loadtxt.
+
+Outputs are synthesized in CAMB's own fixed-width format with the default
+l_max_scalar=2200, so no CAMB executable is needed. Run as ::
+
+    python benchmarks/bench_parsers.py [--repeat N]
+
+"""
+
+import os, sys, argparse, timeit
+from numpy import arange, random
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from camb4py.camb4py import _parsers
+
+
+def camb_format(ncols, nrows):
+    """Text of an output file with an integer first column and ncols-1 E15.5 columns, like CAMB writes."""
+    x = arange(2,nrows+2)
+    data = random.lognormal(size=(nrows,ncols-1))
+    return ''.join(('%6i'%l)+''.join('%15.5E'%v for v in row)+'\n' for l,row in zip(x,data)).encode()
+
+
+outputs = {'scalar':camb_format(4,2199),
+           'scalar (do_lensing)':camb_format(6,2199),
+           'lensed':camb_format(5,2099),
+           'tensor':camb_format(5,1499),
+           'transfer':camb_format(7,200),
+           'transfer_matterpower':camb_format(2,200)}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=50, help='number of times to parse each file')
+    args = parser.parse_args()
+    
+    print('%-24s %12s %12s %9s'%('output','loadtxt [ms]','fast [ms]','speed-up'))
+    for name, data in outputs.items():
+        t = {p:min(timeit.repeat(lambda: _parsers[p](data), number=args.repeat, repeat=3))/args.repeat*1e3
+             for p in ['loadtxt','fast']}
+        print('%-24s %12.3f %12.3f %8.1fx'%(name, t['loadtxt'], t['fast'], t['loadtxt']/t['fast']))
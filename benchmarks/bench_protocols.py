@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Benchmark the overhead of calling CAMB through camb4py with each protocol.
+
+A stub CAMB executable (stub_camb.py) which just writes outputs of the right size
+is used by default, so this measures the cost of the wrapper itself and runs
+without the Fortran build. Each protocol/output combination runs in a fresh
+process so that peak memory use can be measured separately. Run as ::
+
+    python benchmarks/bench_protocols.py [-n 100] [--workers 1] [--output results.json]
+
+"""
+
+import os, sys, json, time, argparse, platform, resource, subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import camb4py
+
+
+combos = {'scalar':{'get_scalar_cls':True},
+          'scalar+lensing':{'get_scalar_cls':True, 'do_lensing':True},
+          'scalar+lensing+transfer':{'get_scalar_cls':True, 'do_lensing':True, 'get_transfer':True},
+          'transfer x4 redshifts':{'get_transfer':True, 'transfer_num_redshifts':4,
+                                   'transfer_redshift(1)':3, 'transfer_redshift(2)':2,
+                                   'transfer_redshift(3)':1, 'transfer_redshift(4)':0}}
+
+protocols = ['disk','pipe','shm','server']
+
+
+def percentile(x, q):
+    x = sorted(x)
+    return x[min(len(x)-1,int(q*len(x)))]
+
+
+def run_single(protocol, combo, n, workers, executable):
+    """Time n calls in this process and return the statistics."""
+    camb = camb4py.load(executable, protocol=protocol)
+    params = [dict(combos[combo], ombh2=0.022+1e-5*i) for i in range(n)]
+    camb(**params[0])
+    camb.reset_timings()
+    
+    latencies = []
+    start = time.perf_counter()
+    if workers==1:
+        for p in params:
+            t = time.perf_counter()
+            camb(**p)
+            latencies.append(time.perf_counter()-t)
+    else:
+        for _,r in camb.imap(params, workers): latencies.append(r['timings']['total'])
+    elapsed = time.perf_counter() - start
+    if hasattr(camb,'close'): camb.close()
+    
+    return {'protocol':protocol, 'outputs':combo, 'n':n, 'workers':workers,
+            'models_per_sec':n/elapsed,
+            'latency_ms':{'p50':1e3*percentile(latencies,.5), 'p95':1e3*percentile(latencies,.95), 
+                          'p99':1e3*percentile(latencies,.99), 'max':1e3*max(latencies)},
+            'stages_p50_ms':{k:1e3*v['p50'] for k,v in camb.timing_stats().items()},
+            'peak_rss_kb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_child_rss_kb':resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', type=int, default=100, help='number of models per benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='number of concurrent CAMB processes')
+    parser.add_argument('--protocols', default=','.join(protocols), help='comma separated protocols to test')
+    parser.add_argument('--executable', default=os.path.join(here,'stub_camb.py'), help='CAMB executable (default: the stub)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--single', nargs=2, metavar=('PROTOCOL','OUTPUTS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.single:
+        print(json.dumps(run_single(args.single[0], args.single[1], args.n, args.workers, args.executable)))
+        return
+    
+    results = []
+    print('%-9s %-25s %10s %9s %9s %11s'%('protocol','outputs','models/s','p50 [ms]','p95 [ms]','peak RSS [MB]'))
+    for protocol in args.protocols.split(','):
+        for combo in combos:
+            out = subprocess.check_output([sys.executable, __file__, '--single', protocol, combo, 
+                                           '-n', str(args.n), '--workers', str(args.workers), 
+                                           '--executable', args.executable])
+            r = json.loads(out.decode().strip().splitlines()[-1])
+            results.append(r)
+            print('%-9s %-25s %10.1f %9.2f %9.2f %11.1f'%(protocol, combo, r['models_per_sec'], r['latency_ms']['p50'],
+                                                         r['latency_ms']['p95'], r['peak_rss_kb']/1024.))
+            
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump({'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'host':platform.node(), 
+                       'python':platform.python_version(), 'numpy':__import__('numpy').__version__,
+                       'executable':args.executable, 'results':results}, f, indent=2)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmark how long a fresh process takes to import camb4py and to load a CAMB,
+which short-lived worker processes pay every time they start.
+
+Each measurement is done in a new interpreter, and also reports which of the slower
+modules (numpy, subprocess, ...) were imported by then. Loading uses the stub CAMB
+(stub_camb.py), with the built-in defaults and with a user ini file. Run as ::
+
+    python benchmarks/bench_startup.py [-n 20] [--output results.json]
+
+"""
+
+import os, sys, json, argparse, subprocess, tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+heavy = ['numpy','subprocess','concurrent.futures','tempfile','configparser','selectors','mmap']
+
+measure = """
+import sys, time, json
+t0 = time.perf_counter()
+import camb4py
+t1 = time.perf_counter()
+camb = camb4py.load(%r, defaults=%r)
+t2 = time.perf_counter()
+camb4py.load(%r, defaults=%r)
+t3 = time.perf_counter()
+print(json.dumps({'import':t1-t0, 'load':t2-t1, 'load_again':t3-t2,
+                  'imported':[m for m in %r if m in sys.modules]}))
+"""
+
+
+def median(x):
+    return sorted(x)[len(x)//2]
+
+
+def run(n, executable, defaults):
+    env = dict(os.environ, PYTHONPATH=root)
+    samples = []
+    for _ in range(n):
+        out = subprocess.check_output([sys.executable, '-c', measure%(executable,defaults,executable,defaults,heavy)],
+                                      env=env, cwd=tempfile.gettempdir())
+        samples.append(json.loads(out))
+    return {'import_ms':1e3*median([s['import'] for s in samples]),
+            'load_ms':1e3*median([s['load'] for s in samples]),
+            'load_again_ms':1e3*median([s['load_again'] for s in samples]),
+            'imported':samples[-1]['imported']}
+
+
+def check_defaults():
+    """Check the quick parse of the defaults at import agrees with read_ini's full one."""
+    sys.path.insert(0, root)
+    from camb4py.camb4py import _defaults, _default_params, _parse_ini
+    if _parse_ini(_defaults)!=_default_params:
+        raise Exception("camb4py.camb4py._parse_plain_ini doesn't parse _defaults like configparser does")
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=20, help='number of fresh processes for each measurement')
+    parser.add_argument('--executable', default=os.path.join(here,'stub_camb.py'), help='CAMB executable to load')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    check_defaults()
+    from camb4py.camb4py import _defaults
+    with tempfile.NamedTemporaryFile('w', suffix='.ini', delete=False) as f:
+        f.write(_defaults)
+    try:
+        results = {'built-in defaults':run(args.n, args.executable, None),
+                   'ini file':run(args.n, args.executable, f.name)}
+    finally:
+        os.remove(f.name)
+
+    print('%-20s %10s %10s %14s   %s'%('defaults','import ms','load ms','load again ms','slow modules imported'))
+    for k,r in results.items():
+        print('%-20s %10.2f %10.2f %14.2f   %s'%(k, r['import_ms'], r['load_ms'], r['load_again_ms'], ', '.join(r['imported']) or '-'))
+
+    if args.output:
+        with open(args.output,'w') as f: json.dump(results, f, indent=2)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Stand-in for a CAMB executable, for benchmarking camb4py without the Fortran build.
+
+Called like CAMB as `stub_camb.py params.ini`, it writes every output file named in the
+ini with the number of rows and columns and the fixed-width format that CAMB would use
+(given l_max_scalar and l_max_tensor), and prints a few lines like CAMB's feedback. Called
+with no arguments it acts like camb4py's server driver instead, reading ini filenames
+from stdin. It does no physics, so timings reflect the cost of the wrapper itself.
+
+"""
+
+import sys
+
+
+def read_ini(filename):
+    params = {}
+    with open(filename) as f:
+        for line in f:
+            if '=' in line:
+                k,v = line.split('=',1)
+                params[k.strip()] = v.strip()
+    return params
+
+
+def output_shapes(p):
+    """Get the (rows, columns) of each output file CAMB would write."""
+    lmax, lmax_tensor = int(p.get('l_max_scalar',2200)), int(p.get('l_max_tensor',1500))
+    lensing = p.get('do_lensing','F').upper().startswith('T')
+    shapes = {'scalar_output_file':(lmax-1, 6 if lensing else 4),
+              'vector_output_file':(lmax-1, 5),
+              'tensor_output_file':(lmax_tensor-1, 5),
+              'lensed_output_file':(lmax-101, 5),
+              'lens_potential_output_file':(lmax-1, 8)}
+    for k in p:
+        if k.startswith('transfer_filename('): shapes[k] = (200, 7)
+        if k.startswith('transfer_matterpower('): shapes[k] = (200, 2)
+    return shapes
+
+
+def run(filename):
+    p = read_ini(filename)
+    for key,(nrows,ncols) in output_shapes(p).items():
+        if p.get(key):
+            integer_l = not key.startswith('transfer')
+            with open(p[key],'w') as f:
+                f.write(''.join((('%6i'%(i+2)) if integer_l else ('%15.5E'%(1e-4*(i+1))))
+                                + '%15.5E'%(1.2345e3/(i+1)) * (ncols-1) + '\n' for i in range(nrows)))
+    print(' Reion redshift       =  10.500')
+    print(' Age of universe/GYr  =  13.777')
+    print(' zstar                =  1090.05')
+    print(' r_s(zstar)/Mpc       =  144.56')
+    sys.stdout.flush()
+
+
+if __name__=='__main__':
+    if len(sys.argv)>1:
+        run(sys.argv[1])
+    else:
+        for line in sys.stdin:
+            run(line.strip())
+            print('CAMB4PY_DONE')
+            sys.stdout.flush()
@@ -1,4 +1,46 @@
 import subprocess, sys
+
+if sys.argv[1:2]==['worker']:
+    from argparse import ArgumentParser
+    from .distributed import worker
+    parser = ArgumentParser(prog='python -m camb4py worker', description='Run CAMB models for a camb4py distributed broker.')
+    parser.add_argument('--connect', required=True, help="the broker's address, host:port or a Unix socket filename")
+    parser.add_argument('--executable', default=None, help='path to CAMB (default: the built-in CAMB)')
+    parser.add_argument('--protocol', default='pipe', help="how to talk to the local CAMB (default: 'pipe')")
+    parser.add_argument('--workers', type=int, default=None, help='number of CAMB processes to run at once (default: number of cores)')
+    parser.add_argument('--variant', default=None, help="build of the built-in CAMB to use, e.g. 'fastest' (default: 'portable')")
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a model is killed and returned as failed')
+    parser.add_argument('--connect-timeout', type=float, default=60, help='seconds to keep trying to connect to the broker (default: 60)')
+    args = parser.parse_args(sys.argv[2:])
+    worker(args.connect, args.executable, protocol=args.protocol, workers=args.workers, variant=args.variant, 
+           timeout=args.timeout, connect_timeout=args.connect_timeout)
+    sys.exit()
+
+if sys.argv[1:2]==['batch']:
+    from argparse import ArgumentParser
+    import json
+    from . import load
+    from .batch import run
+    parser = ArgumentParser(prog='python -m camb4py batch', description='Run CAMB models given as lines of JSON, storing their outputs in a directory.',
+                            epilog='Exits with status 0 if every model worked, 2 if some failed, and 1 if all of them failed.')
+    parser.add_argument('input', nargs='?', default='-', help="file with the parameters of one model per line, or '-' for stdin (default)")
+    parser.add_argument('-o', '--output', required=True, help='directory to store the outputs in')
+    parser.add_argument('--params', type=json.loads, default=None, help='JSON object of parameters common to all models')
+    parser.add_argument('--defaults', default=None, help='ini file with the default parameters')
+    parser.add_argument('--executable', default=None, help='path to CAMB (default: the built-in CAMB)')
+    parser.add_argument('--protocol', default='pipe', help="how to talk to CAMB (default: 'pipe')")
+    parser.add_argument('--workers', type=int, default=None, help='number of models to run at once (default: number of cores)')
+    parser.add_argument('--variant', default=None, help="build of the built-in CAMB to use, e.g. 'fastest' (default: 'portable')")
+    parser.add_argument('--timeout', type=float, default=None, help='seconds after which a model is stopped and counted as failed')
+    parser.add_argument('--progress', type=float, default=5, help='seconds between progress reports on stderr (default: 5)')
+    args = parser.parse_args(sys.argv[2:])
+    camb = load(args.executable, defaults=args.defaults, protocol=args.protocol, variant=args.variant, timeout=args.timeout)
+    lines = sys.stdin if args.input=='-' else open(args.input)
+    with lines:
+        done, failed = run(camb, lines, args.output, workers=args.workers, base_params=args.params, progress=args.progress)
+    #1 if nothing worked, 2 if only some models failed
+    sys.exit(0 if not failed else 1 if not done else 2)
+
 from .camb4py import get_default_executable
 
 camb_exec = get_default_executable()
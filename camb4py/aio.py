@@ -0,0 +1,159 @@
+"""
+
+asyncio interface to CAMB, used by camb.acall.
+
+CAMB runs in a child process created with asyncio.create_subprocess_exec, and
+with the pipe protocol the output FIFOs are read without blocking the event loop,
+so any number of calls can be awaited at once.
+
+"""
+
+import os, time, asyncio
+from contextvars import copy_context
+from .camb4py import camb_disk, camb_pipe, _timings, _timer, _kill, _no_output
+
+
+async def acall(camb, params):
+    """Call CAMB with the given parameters from a coroutine. See camb.acall."""
+    timings, start = {}, time.perf_counter()
+    token = _timings.set(timings)
+    try:
+        params = camb._apply_defaults(params)
+        if camb.cache is None:
+            result = await _run_or_rescale(camb, params)
+        else:
+            with _timer('cache'):
+                key = camb.cache.key(camb.executable, params)
+                result = camb.cache.get(key)
+            if result is None:
+                t0 = time.time()
+                result = await _run_or_rescale(camb, params)
+                camb.cache.put(key, result, time.time() - t0, camb._result_names(params))
+    finally:
+        _timings.reset(token)
+    timings['total'] = time.perf_counter() - start
+    camb._record_timings(result, timings, params)
+    return camb._make_result(result, params)
+
+
+async def _run_or_rescale(camb, params):
+    if not camb.fast_primordial:
+        async with _semaphore(camb): return await _run_with_deadline(camb, params)
+    from .primordial import rescaled, add_reference
+    result = rescaled(camb, params)
+    if result is None:
+        async with _semaphore(camb): result = await _run_with_deadline(camb, params)
+        add_reference(camb, params, result)
+    return result
+
+
+async def _run_with_deadline(camb, params):
+    """Run CAMB, killing it after camb.timeout seconds, in which case the outputs are TimeoutErrors."""
+    #other protocols run in a thread, which handles the timeout itself
+    if camb.timeout is None or type(camb) not in (camb_disk,camb_pipe): return await _run(camb, params)
+    try: 
+        return await asyncio.wait_for(_run(camb, params), camb.timeout)
+    except asyncio.TimeoutError:
+        e = TimeoutError("CAMB didn't finish within %g seconds and was killed"%camb.timeout)
+        print('Warning: %s'%e)
+        return camb._failed(params, e)
+
+
+def _semaphore(camb):
+    """Get the semaphore limiting the number of CAMB processes for this camb object and event loop."""
+    loop = asyncio.get_running_loop()
+    if getattr(camb,'_async_semaphore',(None,))[0] is not loop:
+        camb._async_semaphore = (loop, asyncio.Semaphore(camb.async_limit or os.cpu_count() or 1))
+    return camb._async_semaphore[1]
+
+
+async def _run(camb, params):
+    loop = asyncio.get_running_loop()
+    if type(camb) not in (camb_disk,camb_pipe):
+        #protocols which talk to CAMB some other way run in a thread
+        return await loop.run_in_executor(None, copy_context().run, camb._run_with_deadline, params)
+
+    use_fifos = isinstance(camb,camb_pipe)
+    output_files, param_file = camb._get_tmp_files(params)
+    readers, proc = {}, None
+    try:
+        for key,filename in output_files.items():
+            params[key] = filename
+            if use_fifos:
+                os.mkfifo(filename)
+                readers[key] = _fifo_reader(filename, loop)
+        with open(param_file,'w') as f: camb._write_ini(params, f)
+
+        with _timer('call_camb'):
+            proc = await asyncio.create_subprocess_exec('./%s'%os.path.basename(camb.executable), param_file,
+                                                        cwd=os.path.dirname(camb.executable),
+                                                        stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.STDOUT,
+                                                        start_new_session=True)
+            stdout, _ = await proc.communicate()
+        if proc.returncode: print('Warning: CAMB failed with exit code %s'%proc.returncode)
+        result = {'stdout':stdout, 'misc':camb._parse_stdout(stdout)}
+
+        for key,filename in output_files.items():
+            rkey = camb._output_name(key)
+            try:
+                if use_fifos:
+                    data = readers[key].finish()
+                    result[rkey] = camb._parse_output(data) if data else _no_output(key)
+                else:
+                    with open(filename,'rb') as f: result[rkey] = camb._parse_output(f.read())
+            except Exception as e:
+                result[rkey] = e
+        return result
+
+    finally:
+        #runs on errors and cancellation too, in which case CAMB is killed
+        if proc is not None and proc.returncode is None:
+            _kill(proc)
+            await asyncio.shield(proc.wait())
+        for r in readers.values(): r.close()
+        for filename in list(output_files.values())+[param_file]:
+            try: os.remove(filename)
+            except OSError: pass
+
+
+class _fifo_reader(object):
+    """Collects everything written to a FIFO without blocking the event loop."""
+
+    def __init__(self, filename, loop):
+        self.loop = loop
+        self.fd = os.open(filename, os.O_RDONLY | os.O_NONBLOCK)
+        self.chunks = []
+        self.retry = None
+        loop.add_reader(self.fd, self._read)
+
+    def _read(self):
+        while True:
+            try: chunk = os.read(self.fd, 2**16)
+            except BlockingIOError: return
+            if chunk:
+                self.chunks.append(chunk)
+            else:
+                self.loop.remove_reader(self.fd)
+                #some systems report EOF before CAMB has opened the FIFO, so check back later
+                if not self.chunks: self.retry = self.loop.call_later(0.01, self.loop.add_reader, self.fd, self._read)
+                return
+
+    def finish(self):
+        """Once CAMB has exited, read whatever is left and return all of the contents."""
+        self.close(drain=True)
+        return b''.join(self.chunks)
+
+    def close(self, drain=False):
+        if self.fd is None: return
+        if self.retry is not None: self.retry.cancel()
+        self.loop.remove_reader(self.fd)
+        if drain:
+            try:
+                while True:
+                    chunk = os.read(self.fd, 2**16)
+                    if not chunk: break
+                    self.chunks.append(chunk)
+            except BlockingIOError: pass
+        os.close(self.fd)
+        self.fd = None
@@ -0,0 +1,192 @@
+"""
+
+Running a stream of models given as JSON lines, e.g. from a shell pipeline, with ::
+
+    python -m camb4py batch params.jsonl -o out/ --workers 8
+    generate_params | python -m camb4py batch -o out/ --params '{"get_scalar_cls":true}'
+
+Each line of the input is a JSON object with the parameters of one model. Models are run
+as they're read, with only a few per worker in flight at once, so any amount of input can
+be processed in bounded memory. The output directory holds
+
+    <output>.bin  : the arrays of each output (e.g. scalar.bin), one after the other as
+                    models finish, in native byte order
+    index.jsonl   : one line per model with the 'index' of its line in the input (from 0),
+                    the quantities CAMB printed ('misc'), and the 'offset', 'shape', and
+                    'dtype' of each of its arrays, or the 'error' if it failed
+
+Models finish in any order, so use read to get them back, ::
+
+    for i, result in camb4py.batch.read('out/'):
+        result['scalar']   #memory-mapped, not read into memory
+
+"""
+
+import os, sys, json, time
+from numpy import ndarray, ascontiguousarray, memmap, dtype as np_dtype
+
+
+def run(camb, lines, directory, workers=None, base_params=None, progress=5, log=None):
+    """
+
+    Run the models given by lines of JSON, storing the results in directory.
+
+    Parameters
+    ----------
+
+    camb : the camb object to use (e.g. from camb4py.load)
+
+    lines : iterable of lines of JSON, e.g. an open file, each giving the parameters of a model
+
+    directory : where to store the results (see above). It mustn't already hold a batch.
+
+    workers, optional : number of models to run at once (default: camb.workers, or the number of cores)
+
+    base_params, optional : parameters common to all models, which those on each line override
+
+    progress, optional : how often (in seconds) to print progress, and to flush finished
+                         models to disk (default: 5)
+
+    log, optional : file to print progress to (default: sys.stderr)
+
+    Returns
+    -------
+    (number of models done, number of models which failed)
+
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    log = log or sys.stderr
+    workers = workers or camb.workers or os.cpu_count() or 1
+    index_file = os.path.join(directory,'index.jsonl')
+    if os.path.exists(index_file): raise ValueError("'%s' already holds a batch."%directory)
+    if not os.path.exists(directory): os.makedirs(directory)
+
+    stats = _stats(workers)
+    outputs, entries = {}, []
+    with open(index_file,'w') as index:
+        def finish(i, future):
+            entry = _store(i, future, directory, outputs, stats)
+            entries.append(json.dumps(entry, default=str))
+            if time.time() - stats.last > progress:
+                _checkpoint(outputs, entries, index)
+                print(stats.report(), file=log, flush=True)
+
+        try:
+            with ThreadPoolExecutor(workers) as pool:
+                pending = {}
+                for i, params in _read_lines(lines, base_params):
+                    pending[pool.submit(_call, camb, params)] = i
+                    if len(pending) >= 2*workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for f in done: finish(pending.pop(f), f)
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done: finish(pending.pop(f), f)
+        finally:
+            _checkpoint(outputs, entries, index)
+            for f in outputs.values(): f.close()
+            print(stats.report(final=True), file=log, flush=True)
+    return stats.done, stats.failed
+
+
+def read(directory):
+    """
+
+    Get the results stored by run, as (index, result) pairs in the order the models finished.
+    Arrays are memory-mapped from the .bin files, and models which failed are skipped.
+
+    """
+    maps = {}
+    with open(os.path.join(directory,'index.jsonl')) as index:
+        for line in index:
+            try: entry = json.loads(line)
+            except ValueError: continue   #a line cut off by a crash
+            if 'error' in entry: continue
+            result = {'misc':entry.get('misc',{})}
+            for k,(offset, shape, dtype) in entry['arrays'].items():
+                if k not in maps: maps[k] = memmap(os.path.join(directory,'%s.bin'%k), mode='r')
+                nbytes = int(np_dtype(dtype).itemsize*_prod(shape))
+                result[k] = maps[k][offset:offset+nbytes].view(dtype).reshape(shape)
+            yield entry['index'], result
+
+
+def _read_lines(lines, base_params):
+    """Yield (line number, params), with the error in place of params for lines which aren't a JSON object."""
+    for i,line in enumerate(lines):
+        if not line.strip(): continue
+        try:
+            params = json.loads(line)
+            if not isinstance(params,dict): raise ValueError("expected a JSON object, got %s"%type(params).__name__)
+        except ValueError as e:
+            yield i, ValueError("Line %i isn't valid parameters (%s)"%(i,e))
+            continue
+        yield i, dict(base_params or {}, **params)
+
+
+def _call(camb, params):
+    if isinstance(params, Exception): raise params
+    return camb(**params)
+
+
+def _store(i, future, directory, outputs, stats):
+    """Append one model's arrays to the .bin files, returning its entry for the index."""
+    try:
+        result = future.result()
+    except Exception as e:
+        stats.add(None)
+        return {'index':i, 'error':str(e)}
+    errors = ['%s: %s'%(k,v) for k,v in result.items() if isinstance(v,Exception)]
+    arrays = {k:ascontiguousarray(v) for k,v in result.items() if isinstance(v,ndarray)}
+    if errors or not arrays:
+        stats.add(None)
+        return {'index':i, 'error':'; '.join(errors) or 'no outputs', 'misc':result.get('misc')}
+    entry = {'index':i, 'misc':result.get('misc'), 'arrays':{}}
+    for k,v in arrays.items():
+        if k not in outputs: outputs[k] = open(os.path.join(directory,'%s.bin'%k),'wb')
+        entry['arrays'][k] = [outputs[k].tell(), list(v.shape), v.dtype.str]
+        outputs[k].write(v.data)
+        stats.nbytes += v.nbytes
+    stats.add(result)
+    return entry
+
+
+def _checkpoint(outputs, entries, index):
+    """Flush the arrays to disk, and only then the index entries pointing at them."""
+    for f in outputs.values(): f.flush()
+    if entries: index.write('\n'.join(entries)+'\n')
+    index.flush()
+    del entries[:]
+
+
+class _stats(object):
+    """Counts for the progress reports."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.done = self.failed = self.nbytes = 0
+        self.camb_time = 0.
+        self.start = self.last = time.time()
+
+    def add(self, result):
+        if result is None:
+            self.failed += 1
+            return
+        self.done += 1
+        self.camb_time += result.get('timings',{}).get('call_camb',0)
+
+    def report(self, final=False):
+        self.last = now = time.time()
+        elapsed = max(now - self.start, 1e-9)
+        s = '%s %i done, %i failed in %.1fs, %.2f models/s, %.1f MB written'%(
+            'camb4py batch finished:' if final else 'camb4py batch:',
+            self.done, self.failed, elapsed, (self.done+self.failed)/elapsed, self.nbytes/1e6)
+        if self.done:
+            #how much of the time the workers spent running CAMB, the rest is overhead or waiting for input
+            s += ', %.2fs per CAMB run, workers %.0f%% busy'%(self.camb_time/self.done, 100*self.camb_time/elapsed/self.workers)
+        return s
+
+
+def _prod(shape):
+    n = 1
+    for s in shape: n *= s
+    return n
@@ -0,0 +1,139 @@
+import os, json, hashlib, shutil
+from collections import OrderedDict
+from tempfile import mkdtemp
+from threading import Lock
+from numpy import ndarray, save, load
+
+
+class result_cache(object):
+    """
+
+    Content-addressed cache of CAMB results.
+
+    Results are keyed on a hash of the executable and the fully defaulted
+    parameters, so the same model is only ever computed once. Recently used
+    results are kept in memory up to max_bytes, and optionally also written to
+    a directory on disk which persists between sessions.
+
+    Parameters
+    ----------
+
+    max_bytes, optional : size limit of the in-memory cache, beyond which
+                          least recently used results are evicted (default: 1GB)
+
+    directory, optional : if given, results are also stored here as .npy files
+                          which are memory-mapped back in on a hit
+                          (default: None, i.e. memory only)
+
+    The attributes hits, misses, and time_saved (seconds of CAMB time avoided)
+    keep track of how useful the cache is being.
+
+    """
+
+    def __init__(self, max_bytes=2**30, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        if directory is not None and not os.path.exists(directory): os.makedirs(directory)
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = Lock()
+        self.hits = self.misses = 0
+        self.time_saved = 0.
+
+    def key(self, executable, params):
+        """Get the hash of a set of parameters."""
+        from .camb4py import try_bool2str, try_str2bool
+        canonical = sorted((k,str(try_bool2str(try_str2bool(v))).strip()) for k,v in params.items())
+        return hashlib.sha1(json.dumps([executable,canonical]).encode()).hexdigest()
+
+    def get(self, key):
+        """Get a copy of a cached result, or None if it isn't in the cache."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None: self._entries.move_to_end(key)
+        if entry is None and self.directory is not None:
+            entry = self._read_disk(key)
+            if entry is not None: self._put_memory(key, entry)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.time_saved += entry[1]
+        return {k:_copy(v) for k,v in entry[0].items()}
+
+    def __contains__(self, key):
+        """Whether a result is in the cache, without counting it as a hit or miss."""
+        with self._lock:
+            if key in self._entries: return True
+        return self.directory is not None and os.path.exists(os.path.join(self._path(key),'meta.json'))
+
+    def put(self, key, result, runtime=0, outputs=()):
+        """
+        Store a result (which took runtime seconds to compute) in the cache. Results of failed
+        runs, i.e. with errors in place of outputs or missing any of the names in outputs, aren't stored.
+        """
+        if any(isinstance(v,Exception) for v in result.values()) or any(k not in result for k in outputs): return
+        entry = ({k:_copy(v) for k,v in result.items()}, runtime)
+        self._put_memory(key, entry)
+        if self.directory is not None: self._write_disk(key, entry)
+
+    def clear(self):
+        """Clear the in-memory cache (the on-disk one is left alone)."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """Get a dictionary of cache statistics."""
+        return {'hits':self.hits, 'misses':self.misses, 'time_saved':self.time_saved,
+                'entries':len(self._entries), 'bytes':self._nbytes}
+
+    def _put_memory(self, key, entry):
+        with self._lock:
+            if key in self._entries: self._nbytes -= _sizeof(self._entries.pop(key)[0])
+            self._entries[key] = entry
+            self._nbytes += _sizeof(entry[0])
+            while self._nbytes > self.max_bytes and self._entries:
+                self._nbytes -= _sizeof(self._entries.popitem(last=False)[1][0])
+
+    def _path(self, key):
+        return os.path.join(self.directory,key[:2],key)
+
+    def _write_disk(self, key, entry):
+        path = self._path(key)
+        if os.path.exists(path): return
+        if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = mkdtemp(dir=os.path.dirname(path))
+        meta = {'runtime':entry[1], 'arrays':[], 'other':{}}
+        for k,v in entry[0].items():
+            if isinstance(v,ndarray):
+                save(os.path.join(tmp,'%s.npy'%k), v)
+                meta['arrays'].append(k)
+            elif k=='stdout':
+                with open(os.path.join(tmp,'stdout'),'wb') as f: f.write(v)
+            else:
+                meta['other'][k] = v
+        with open(os.path.join(tmp,'meta.json'),'w') as f: json.dump(meta, f)
+        try: os.rename(tmp, path)
+        except OSError: shutil.rmtree(tmp, ignore_errors=True)
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(os.path.join(path,'meta.json')) as f: meta = json.load(f)
+            result = dict(meta['other'])
+            for k in meta['arrays']: result[k] = load(os.path.join(path,'%s.npy'%k), mmap_mode='c')
+            if os.path.exists(os.path.join(path,'stdout')):
+                with open(os.path.join(path,'stdout'),'rb') as f: result['stdout'] = f.read()
+            return (result, meta['runtime'])
+        except (IOError, OSError, ValueError):
+            return None
+
+
+def _copy(value):
+    #arrays and dicts (e.g. misc) are copied so callers changing them don't change the cached result
+    return value.copy() if isinstance(value,(ndarray,dict)) else value
+
+def _sizeof(result):
+    return sum(v.nbytes if isinstance(v,ndarray) else len(v) if isinstance(v,bytes) else 0 for v in result.values())
@@ -1,11 +1,15 @@
-import os, re, subprocess
-from configparser import RawConfigParser
-from io import StringIO
-from tempfile import mktemp
-from threading import Thread, Event
-from numpy import loadtxt
-
-def load(executable=None, defaults=None, protocol='disk'):
+import os, re, time
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from collections import deque
+from threading import Thread, Lock, Condition
+from queue import Queue, Empty
+
+#numpy, subprocess, and other slower imports are done where they're needed, so that 
+#importing camb4py and calling load() stay fast for short-lived processes
+
+def load(executable=None, defaults=None, protocol='disk', cache=None, parser='fast', result_type='dict', variant=None, **kwargs):
     """
     
     Prepare a CAMB executable to be called from Python.
@@ -22,24 +26,259 @@ def load(executable=None, defaults=None, protocol='disk'):
     protocol, optional : one of 'pipe' or 'disk'. this specifies how Python communicates
                          with CAMB. 'pipe' is based on Unix name pipes and is
                          very fast, but may not always work with every compiler/OS combination.
-                         'disk' just reads/writes files to disk so it is slower but more stable
+                         'disk' just reads/writes files to disk so it is slower but more stable.
+                         'shm' is like 'disk' but uses a reusable scratch folder in RAM (/dev/shm), 
+                         which is as fast as 'pipe' on systems where pipes are unreliable.
+                         'server' keeps CAMB processes running and feeds them successive
+                         parameter files, which saves the start-up cost of each call, but needs
+                         a CAMB built with the camb4py server driver (like the built-in one).
+                         'distributed' sends each model to one of any number of workers, possibly
+                         on other machines, see camb4py.distributed.
                          (default: 'disk')
                          
+    cache, optional : if True, or a camb4py.cache.result_cache object, results are cached 
+                      so repeated calls with the same parameters don't re-run CAMB. 
+                      a result_cache can be shared between several camb objects.
+                      (default: None, i.e. no caching)
+                      
+    parser, optional : 'fast', 'loadtxt', or a function which takes the raw bytes of 
+                       a CAMB output file and returns an array. if the parser fails,
+                       numpy.loadtxt is used as a fallback. (default: 'fast')
+                       
+    result_type, optional : 'dict' to return results as a dict of arrays, or 'object' to 
+                            return camb4py.results.camb_result objects, which give named 
+                            access to columns, e.g. result.lensed.BB, or 'shared' to return
+                            camb4py.shm.shared_result objects, whose arrays are in shared memory
+                            so they can be sent to other processes without copying (default: 'dict')
+                       
+    variant, optional : which build of the built-in CAMB to use, one of 'portable', 'native', 'pgo', 
+                        or 'fastest' to pick the fastest of these which works on this machine, 
+                        see camb4py.variants. with protocol='distributed', give it to the workers 
+                        instead (default: None, i.e. 'portable')
+                       
+    timeout, optional : seconds after which a CAMB run is killed, along with any processes it
+                        started. the outputs in its result are then TimeoutErrors, so that
+                        e.g. camb.map carries on with the other models (default: None)
+                        
+    speculate, optional : if True, once there have been a few calls, any run which takes longer 
+                          than 95% of those so far is duplicated, and whichever copy finishes 
+                          first is used while the other is killed. this caps the time taken by 
+                          the odd run which gets stuck on a slow or overloaded machine
+                          (default: False)
+                       
+    validate, optional : whether to check the parameters of each call before running CAMB, raising 
+                         a ValueError for any which CAMB doesn't read (e.g. typos, which CAMB would
+                         otherwise silently ignore), with a malformed index, or with a value of the
+                         wrong type. can also be the folder of the CAMB source code to read the valid 
+                         parameters from (default: True for the built-in CAMB, whose parameters are 
+                         indexed by setup.py build, otherwise False)
+                       
+    fast_primordial, optional : if True, models which differ only in the primordial power spectrum
+                                share CAMB runs, see camb4py.primordial (default: False)
+                       
+    **kwargs : any extra options for the particular protocol, see e.g. camb4py.camb_server
+                         
     Returns
     -------
     camb object which can be called with a list of parameters
     
     """
-    return {'disk':camb_disk, 'pipe':camb_pipe}[protocol](executable,defaults)
+    if result_type=='shared':
+        #pick the prefix of shared memory blocks now, so worker processes started later inherit it
+        from .shm import init
+        init()
+    if protocol=='distributed':
+        if variant is not None: 
+            raise ValueError("With protocol='distributed' each worker uses its own CAMB, so give the variant to the workers instead, "
+                             "e.g. python -m camb4py worker --variant %s"%variant)
+        from .distributed import camb_distributed
+        return camb_distributed(executable,defaults,cache=cache,parser=parser,result_type=result_type,**kwargs)
+    cls = {'disk':camb_disk, 'pipe':camb_pipe, 'shm':camb_shm, 'server':camb_server}[protocol]
+    if variant is not None:
+        if executable is not None: raise ValueError("variant picks a build of the built-in CAMB, so can't be given with executable")
+        from .variants import get_variant_executable
+        executable = get_variant_executable(cls.default_executable, variant)
+    return cls(executable,defaults,cache=cache,parser=parser,result_type=result_type,**kwargs)
+
+
+
+#timings of the call currently in progress in this thread/task
+_timings = ContextVar('camb4py_timings', default=None)
+_max_timing_samples = 100000
+
+#speculative runs start once there are this many timings, and the 95th percentile is updated every so many calls
+_min_speculation_samples = 20
+_speculation_refresh = 20
+
+@contextmanager
+def _timer(stage):
+    """Add the time spent in this block to the current call's timings for the given stage."""
+    start = time.perf_counter()
+    try: yield
+    finally:
+        timings = _timings.get()
+        if timings is not None: timings[stage] = timings.get(stage,0) + time.perf_counter() - start
+        
+@contextmanager
+def _affinity(cpus):
+    """Pin the current thread to the given CPUs in this block, so any processes it starts inherit them."""
+    if cpus is None: 
+        yield
+        return
+    old = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try: yield
+    finally: os.sched_setaffinity(0, old)
+        
+def _timed(stage):
+    """Decorator version of _timer."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with _timer(stage): return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+
+#deadline and cancellation of the call currently in progress in this thread
+_control = ContextVar('camb4py_control', default=None)
+
+class _call_control(object):
+    """
+    The deadline of a call (timeout seconds from now), and a way to cancel it from another thread. 
+    A call within another (parent) one also has the parent's deadline if it's sooner, and is 
+    cancelled along with it.
+    """
+    
+    def __init__(self, timeout=None, parent=None):
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.cancelled = False
+        self.cond = Condition()
+        self.children = []
+        if parent is not None:
+            with parent.cond:
+                parent.children.append(self)
+                self.cancelled = parent.cancelled
+            if parent.deadline is not None and (self.deadline is None or parent.deadline < self.deadline):
+                self.timeout, self.deadline = parent.timeout, parent.deadline
+        
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+            children = list(self.children)
+        for child in children: child.cancel()
+            
+class _cancelled(Exception): pass
+            
+class _watchdog(object):
+    """
+    While in this block, kill a CAMB process (and anything it started) if the current call's 
+    deadline passes or the call is cancelled. check() afterwards raises TimeoutError or 
+    _cancelled if it was killed.
+    """
+    
+    def __init__(self, proc):
+        self.proc, self.control, self.killed, self.finished = proc, _control.get(), False, False
+        
+    def __enter__(self):
+        if self.control is not None:
+            self.thread = Thread(target=self._watch, daemon=True)
+            self.thread.start()
+        return self
+    
+    def _watch(self):
+        control = self.control
+        with control.cond:
+            while not self.finished and not control.cancelled:
+                remaining = None if control.deadline is None else control.deadline - time.monotonic()
+                if remaining is not None and remaining <= 0: break
+                control.cond.wait(remaining)
+            if self.finished or getattr(self.proc,'returncode',None) is not None: return
+            self.killed = True
+        _kill(self.proc)
+        
+    def __exit__(self, *exc):
+        if self.control is not None:
+            with self.control.cond:
+                self.finished = True
+                self.control.cond.notify_all()
+            self.thread.join()
+        
+    def check(self):
+        if self.killed:
+            if self.control.cancelled: raise _cancelled()
+            raise TimeoutError("CAMB didn't finish within %g seconds and was killed"%self.control.timeout)
+        
+def _kill(proc):
+    """Kill a CAMB process started with start_new_session=True, along with anything it started."""
+    import signal
+    try: os.killpg(proc.pid, signal.SIGKILL)
+    except (OSError, AttributeError):
+        try: proc.kill()
+        except OSError: pass
 
 
 
 class camb(object):
     
-    def __init__(self, executable=None, defaults=None):
+    default_executable = 'camb'
+    async_limit = None
+    workers = None
+    
+    def __init__(self, executable=None, defaults=None, cache=None, parser='fast', result_type='dict', fast_primordial=False,
+                 timeout=None, speculate=False, validate=None):
         self.defaults = read_ini(defaults or _defaults)
+        if result_type not in ['dict','object','shared']: raise ValueError("result_type should be 'dict', 'object', or 'shared'")
+        self.result_type = result_type
+        self.fast_primordial = fast_primordial
+        self.timeout = timeout
+        self.speculate = speculate
+        self.validate = validate
+        self._valid_params = None
+        if cache is True:
+            from .cache import result_cache
+            cache = result_cache()
+        self.cache = cache or None
+        self.parser = _parsers.get(parser,parser)
+        self.executable = self._find_executable(executable)
+        self.output_names = _output_names
+        self.hooks = []
+        self._timing_samples = {}
+        self._timing_lock = Lock()
+        self._ncalls, self._speculation = 0, (None, None)
+        self.cpu_sets = None
+        
+    @property
+    def cpu_sets(self):
+        """
+        List of sets of CPUs (e.g. from camb4py.tune.tune), or None. If given, each CAMB process
+        is pinned to one of these which no other running CAMB process is using, and calls wait 
+        for one to be free. Processes started by acall aren't pinned.
+        """
+        return self._cpu_sets
+    
+    @cpu_sets.setter
+    def cpu_sets(self, cpu_sets):
+        self._cpu_sets = [set(c) for c in cpu_sets] if cpu_sets else None
+        self._free_cpus = Queue()
+        for c in self._cpu_sets or []: self._free_cpus.put(c)
+        
+    def _take_cpus(self, block=True):
+        """Get a set of CPUs from cpu_sets which no CAMB process is using, or None."""
+        if self._cpu_sets is None or not hasattr(os,'sched_setaffinity'): return None
+        try: return self._free_cpus.get(block)
+        except Empty: return None
+        
+    def _release_cpus(self, cpus):
+        #unless cpu_sets has been changed since these were taken
+        if cpus is not None and any(cpus is c for c in self._cpu_sets or []): self._free_cpus.put(cpus)
+        
+    def _find_executable(self, executable):
         if executable is None:
-            executable = get_default_executable()
+            executable = get_default_executable(self.default_executable)
             if executable is None: 
                 raise Exception(("Couldn't find the default camb executable. Please specify one with 'executable=/path/to/camb'\n"
                                  "Possible reasons:\n"
@@ -48,11 +287,154 @@ class camb(object):
                                  " * You are currently in the installation folder (cd somewhere else)\n"))
         elif not os.path.exists(executable): 
             raise Exception("Couldn't find CAMB executable '%s'"%executable)
-        self.executable = os.path.abspath(executable)
-        self.output_names = _output_names
+        return os.path.abspath(executable)
+        
+    def __call__(self, **params):
+        """
+        
+        Call CAMB and return the output files as well as stdout. 
+        
+        Parameters
+        ----------
+        
+        **params : all key value pairs are passed to the CAMB ini, except for
+        
+            outputs : list of the outputs wanted, from 'scalar', 'vector', 'tensor', 'lensed', 
+                      'lens_potential', 'transfer', and 'transfer_matterpower'. the get_*_cls, 
+                      get_transfer, and do_lensing switches are then set to compute just these, 
+                      and no other output files are written or parsed.
+                      
+            lmax : the largest l wanted in the Cl outputs. l_max_scalar and l_max_tensor are set 
+                   to the smallest values which give this (for lensed Cl's, lmax plus the 100 
+                   multipoles CAMB needs for the lensing), and rows beyond lmax are dropped.
+        
+        Returns
+        -------
+        dict with the outputs, CAMB's stdout, the quantities parsed from it ('misc'), 
+        and a breakdown of where the time was spent ('timings', see camb.timing_stats),
+        or the same as a camb_result if this object was loaded with result_type='object'
+        
+        """
+        timings, start = {}, time.perf_counter()
+        token = _timings.set(timings)
+        try:
+            params = self._apply_defaults(params)
+            if self.cache is None: 
+                result = self._run_or_rescale(params)
+            else:
+                with _timer('cache'):
+                    key = self.cache.key(self.executable, params)
+                    result = self.cache.get(key)
+                if result is None:
+                    t0 = time.time()
+                    result = self._run_or_rescale(params)
+                    self.cache.put(key, result, time.time() - t0, self._result_names(params))
+        finally:
+            _timings.reset(token)
+        timings['total'] = time.perf_counter() - start
+        self._record_timings(result, timings, params)
+        return self._make_result(result, params)
+        
+    def _run_or_rescale(self, params):
+        """Run CAMB, or with fast_primordial, rescale an earlier result which differs only in scalar_amp(1)."""
+        if not self.fast_primordial: return self._run_with_deadline(params)
+        from .primordial import rescaled, add_reference
+        result = rescaled(self, params)
+        if result is None:
+            result = self._run_with_deadline(params)
+            add_reference(self, params, result)
+        return result
+        
+    def _run_with_deadline(self, params):
+        """
+        Run CAMB, killing it if it takes longer than camb.timeout, in which case the outputs 
+        in the result are TimeoutErrors. With camb.speculate, a duplicate run is started if 
+        the first takes longer than 95% of runs so far, and the first to finish is used.
+        """
+        if self.timeout is None and not self.speculate: return self._run(params)
+        delay = self._speculation_delay() if self.speculate else None
+        try:
+            if delay is None:
+                token = _control.set(_call_control(self.timeout, _control.get()))
+                try: return self._run(params)
+                finally: _control.reset(token)
+            return self._run_speculative(params, delay)
+        except TimeoutError as e:
+            print('Warning: %s'%e)
+            return self._failed(params, e)
+            
+    def _failed(self, params, error):
+        """A result for a run which failed, with the error in place of each output."""
+        result = {'stdout':b'', 'misc':{}}
+        for key in self._get_output_keys(params): result[self._output_name(key)] = error
+        return result
         
-    def derivative(self, dparam, params, epsilon=None):
-        """Get a derivative."""
+    def _run_speculative(self, params, delay):
+        from concurrent.futures import Future, wait, FIRST_COMPLETED
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        parent = _control.get()
+        
+        def start():
+            control = _call_control(None if deadline is None else deadline - time.monotonic(), parent)
+            future, timings = Future(), {}
+            def run():
+                _control.set(control)
+                _timings.set(timings)
+                try: future.set_result(self._run(dict(params)))
+                except BaseException as e: future.set_exception(e)
+            Thread(target=copy_context().run, args=(run,), daemon=True).start()
+            return future, control, timings
+        
+        runs = [start()]
+        if not wait([runs[0][0]], timeout=delay).done: runs.append(start())
+        error = None
+        while runs:
+            done, _ = wait([r[0] for r in runs], return_when=FIRST_COMPLETED)
+            for r in [r for r in runs if r[0] in done]:
+                runs.remove(r)
+                if r[0].exception() is None:
+                    for other in runs: other[1].cancel()
+                    timings = _timings.get()
+                    if timings is not None: 
+                        for k,v in r[2].items(): timings[k] = timings.get(k,0) + v
+                    return r[0].result()
+                if error is None or isinstance(error,_cancelled): error = r[0].exception()
+        raise error
+        
+    def _speculation_delay(self):
+        """The 95th percentile of how long CAMB has taken, or None if there aren't enough calls yet to know."""
+        with self._timing_lock:
+            if self._speculation[0] is None or self._ncalls - self._speculation[0] >= _speculation_refresh:
+                samples = self._timing_samples.get('call_camb',())
+                if len(samples) >= _min_speculation_samples:
+                    self._speculation = (self._ncalls, sorted(samples)[int(.95*len(samples))])
+            return self._speculation[1]
+        
+    def derivative(self, dparam, params, epsilon=None, step=None, nsteps=5, workers=None):
+        """
+        
+        Get a derivative. 
+        
+        With a numerical epsilon, this is a single two-point difference with that step. 
+        Otherwise (epsilon=None or 'adaptive') the step is picked automatically: central 
+        differences with steps step, step/2, ..., step/2**(nsteps-1) are combined by Richardson 
+        extrapolation, and at each row and column the estimate with the smallest error is kept, 
+        so neither CAMB's numerical noise (small steps) nor truncation error (large steps) 
+        dominates. The result then has an extra entry 'error' holding, for each output, the
+        estimated error of the derivative in the same shape as the output. All of the runs 
+        are done concurrently by up to workers CAMB processes, and are cached 
+        (in camb.cache, or a private cache if that's None) so later derivatives reuse them. 
+        step defaults to 5% of the parameter's value.
+        
+        """
+        if epsilon is None or epsilon=='adaptive':
+            deriv, error = self._adaptive_derivatives([dparam], params, [step], nsteps, workers)
+            #outputs which weren't differentiated (transfer_redshifts) are the same for every parameter
+            result = {k:(v[0] if k in error else v) for k,v in deriv.items()}
+            result['error'] = {k:v[0] for k,v in error.items()}
+            return result
+        
+        from numpy import ndarray
         params = self._apply_defaults(params)
         try:
             x0 = float(params[dparam])
@@ -65,48 +447,373 @@ class camb(object):
             d0 = self(**params)
         
             for k,v in list(d1.items()):
-                if k not in ['stdout','misc']: v[:,1:] = (v[:,1:] - d0[k][:,1:])/epsilon
+                if isinstance(v,ndarray) and v.ndim>1: v[...,1:] = (v[...,1:] - d0[k][...,1:])/epsilon
             
             d1['stdout'] = (d0['stdout'],d1['stdout'])
             d1['misc'] = (d0['misc'],d1['misc'])
             return d1
         
+    def jacobian(self, params_list, base_params, steps=None, method='central', workers=None):
+        """
+        
+        Get derivatives with respect to several parameters at once. All of the 
+        required CAMB runs are scheduled together and run concurrently, and runs 
+        shared between parameters (e.g. the model at base_params) are done only once.
+        
+        Parameters
+        ----------
+        
+        params_list : list of names of parameters to differentiate with respect to
+        
+        base_params : dict of parameters at which to take the derivatives
+        
+        steps : step size, either one number for all parameters, or a list 
+                (in the order of params_list) or dict with one per parameter.
+                for method='adaptive' these are the largest steps tried, and are optional
+                
+        method, optional : one of 'central', 'forward', 'five-point', or 'adaptive' 
+                           (default: 'central'). 'adaptive' picks the steps automatically 
+                           as in camb.derivative, and adds an entry 'error' to the result 
+                           holding the estimated errors in the same form as the derivatives
+        
+        workers, optional : maximum number of CAMB processes to run at once (see camb.map)
+        
+        Returns
+        -------
+        dict mapping each output (e.g. 'scalar', 'lensed') to an array of shape 
+        (n_params, n_rows, n_cols), or (n_params, n_z, n_k, n_cols) for transfer outputs 
+        at several redshifts. The first column holds the l or k values as in the original 
+        output, the rest are the derivatives. transfer_redshifts is passed through as is.
+        
+        """
+        if method not in _stencils and method!='adaptive': 
+            raise ValueError("Unknown method '%s', expected one of %s"%(method,list(_stencils)+['adaptive']))
+        if isinstance(steps,dict): steps = [steps.get(p) for p in params_list]
+        elif not hasattr(steps,'__len__'): steps = [steps]*len(params_list)
+        
+        if method=='adaptive':
+            jac, jac['error'] = self._adaptive_derivatives(params_list, base_params, steps, workers=workers)
+            return jac
+        if None in steps: raise ValueError("Steps are needed for method '%s'"%method)
+        offsets, coeffs = _stencils[method]
+        from numpy import ndarray, empty
+        
+        #all parameters share the run at the base point
+        point = lambda dparam, o: (dparam,o) if o else (None,0)
+        
+        base = self._apply_defaults(base_params)
+        points = {}
+        for dparam, h in zip(params_list, steps):
+            try: x0 = float(base[dparam])
+            except: raise Exception("Can't take derivative of non-numerical parameter '%s'=%s"%(dparam,base.get(dparam)))
+            for o in offsets:
+                if point(dparam,o) in points: continue
+                p = base.copy()
+                p[dparam] = x0 + o*h
+                points[point(dparam,o)] = p
+        
+        keys = list(points)
+        results = dict(zip(keys, self.map([points[k] for k in keys], workers)))
+        
+        some = next(iter(results.values()))
+        jac = {}
+        for k,v in some.items():
+            if not isinstance(v,ndarray): continue
+            if v.ndim<2: 
+                jac[k] = v.copy()
+                continue
+            jac[k] = empty((len(params_list),)+v.shape)
+            for i,(dparam,h) in enumerate(zip(params_list, steps)):
+                jac[k][i,...,0] = v[...,0]
+                jac[k][i,...,1:] = sum(c*results[point(dparam,o)][k][...,1:] for o,c in zip(offsets,coeffs))/h
+        return jac
+
+    def _adaptive_derivatives(self, params_list, base_params, steps, nsteps=5, workers=None):
+        """
+        Derivatives by Ridders' method, i.e. Richardson extrapolation of central differences 
+        with halving steps, keeping the extrapolation with the smallest error at each element.
+        Returns dicts of derivatives and errors, each of shape (n_params, n_rows, n_cols), 
+        with 1-D outputs (transfer_redshifts) passed through as is.
+        """
+        from numpy import ndarray, empty, where, maximum, minimum
+        if nsteps < 2: raise ValueError("Need at least 2 steps to estimate the error, got nsteps=%s"%nsteps)
+        base = self._apply_defaults(base_params)
+        points, hs = {}, []
+        for dparam, h in zip(params_list, steps):
+            try: x0 = float(base[dparam])
+            except: raise Exception("Can't take derivative of non-numerical parameter '%s'=%s"%(dparam,base.get(dparam)))
+            if h is None: h = 0.05*abs(x0) or 0.05
+            hs.append(h)
+            for i in range(nsteps):
+                for o in (-1,1):
+                    p = base.copy()
+                    p[dparam] = x0 + o*h/2**i
+                    points[(dparam,i,o)] = p
+        
+        keys = list(points)
+        results = dict(zip(keys, self._map_cached([points[k] for k in keys], workers)))
+        
+        some = next(iter(results.values()))
+        deriv, error = {}, {}
+        for k,v in some.items():
+            if not isinstance(v,ndarray): continue
+            if v.ndim<2:
+                deriv[k] = v.copy()
+                continue
+            deriv[k], error[k] = empty((len(params_list),)+v.shape), empty((len(params_list),)+v.shape)
+            deriv[k][...,0] = error[k][...,0] = v[...,0]
+            for n,(dparam,h) in enumerate(zip(params_list, hs)):
+                diffs = [(results[(dparam,i,1)][k][...,1:] - results[(dparam,i,-1)][k][...,1:])/(2*h/2**i) for i in range(nsteps)]
+                #the smallest steps give an (over)estimate of the noise in CAMB's outputs, 
+                #which is amplified by 1/step and sets a floor on the error at each step
+                noise = maximum.reduce([abs(diffs[i]-diffs[i-1])*h/2**i for i in range(max(1,nsteps-2),nsteps)])
+                best, besterr, prev = None, None, None
+                for i in range(nsteps):
+                    row = [diffs[i]]
+                    for j in range(1,i+1):
+                        row.append(row[j-1] + (row[j-1] - prev[j-1])/(4**j - 1))
+                        err = maximum.reduce([abs(row[j]-row[j-1]), abs(row[j]-prev[j-1]), noise/(h/2**i)] + 
+                                             ([abs(row[j]-prev[j])] if j<i else []))
+                        if best is None: best, besterr = row[j], err
+                        else: best, besterr = where(err<besterr, row[j], best), minimum(err, besterr)
+                    prev = row
+                deriv[k][n,...,1:], error[k][n,...,1:] = best, besterr
+        return deriv, error
+    
+    def _map_cached(self, params_list, workers=None):
+        """Like map, but caching the results even if this object has no cache."""
+        if self.cache is not None: return self.map(params_list, workers)
+        if getattr(self,'_private_cache',None) is None: 
+            from .cache import result_cache
+            self._private_cache = result_cache()
+        cache = self._private_cache
+        keys = [cache.key(self.executable, self._apply_defaults(p)) for p in params_list]
+        results = [cache.get(key) for key in keys]
+        missing = [i for i,r in enumerate(results) if r is None]
+        for i,r in zip(missing, self.map([params_list[i] for i in missing], workers)):
+            cache.put(keys[i], r.to_dict() if hasattr(r,'to_dict') else r)
+            results[i] = r
+        return results
+    
+    async def acall(self, **params):
+        """
+        
+        Coroutine version of calling CAMB, for use with asyncio, e.g. 
+        
+            result = await camb.acall(get_scalar_cls=True)
+        
+        Any number of calls can be in flight at once, but at most camb.async_limit 
+        CAMB processes run concurrently (default: number of cores). Cancelling the 
+        call kills the CAMB process and cleans up its files.
+        
+        """
+        from .aio import acall
+        return await acall(self, params)
+
+    def timing_stats(self):
+        """
+        
+        Get statistics of how long each stage of calling CAMB has taken over all 
+        calls so far (or since reset_timings). The stages are,
+        
+            apply_defaults : merging the parameters with the defaults
+            write_ini      : writing the ini file (for 'pipe', includes waiting for CAMB to read it)
+            call_camb      : running the CAMB process
+            parse_stdout   : parsing CAMB's printed output
+            parse_outputs  : parsing all of the output files
+            cache          : looking up the result in the cache, if there is one
+            total          : the whole call (for 'pipe', some of the stages overlap)
+        
+        Returns
+        -------
+        dict of {stage: {'n', 'mean', 'p50', 'p95'}}, with times in seconds
+        
+        """
+        with self._timing_lock: samples = {k:sorted(v) for k,v in self._timing_samples.items()}
+        return {k:{'n':len(v), 'mean':sum(v)/len(v), 'p50':v[len(v)//2], 'p95':v[min(len(v)-1,int(.95*len(v)))]}
+                for k,v in samples.items()}
+        
+    def reset_timings(self):
+        """Clear the timing statistics."""
+        with self._timing_lock: 
+            self._timing_samples.clear()
+            self._speculation = (None, None)
+        
+    def _record_timings(self, result, timings, params):
+        """Attach timings to a result, add them to the statistics, and pass them to any hooks."""
+        result['timings'] = timings
+        with self._timing_lock:
+            self._ncalls += 1
+            for k,v in timings.items(): 
+                self._timing_samples.setdefault(k,deque(maxlen=_max_timing_samples)).append(v)
+        for hook in self.hooks: hook(timings, params)
+
+    def _make_result(self, result, params):
+        if 'camb4py_lmax' in params: _trim_lmax(result, int(params['camb4py_lmax']))
+        if try_str2bool(params.get('get_transfer')) is True and int(params.get('transfer_num_redshifts',1))>1: 
+            _stack_redshifts(result, params)
+        if self.result_type=='dict': return result
+        if self.result_type=='shared':
+            from .shm import shared_result
+            return shared_result.from_result(result)
+        from .results import camb_result
+        return camb_result(result, params)
+
+    def map(self, params_list, workers=None):
+        """
+        
+        Call CAMB for many parameter sets concurrently.
+        
+        Parameters
+        ----------
+        
+        params_list : iterable of dicts of parameters, each passed as in camb(**params)
+        
+        workers, optional : maximum number of CAMB processes running at once.
+                            you probably want to set number_of_threads in the ini 
+                            so that workers*number_of_threads doesn't exceed your cores,
+                            or let camb4py.tune.tune pick both
+                            (default: camb.workers if set, otherwise the number of cores)
+                            
+        With fast_primordial, models which differ only in scalar_amp(1), scalar_spectral_index(1), 
+        and scalar_nrun(1) are run together, see camb4py.primordial.
+                            
+        Returns
+        -------
+        list of results, in the same order as params_list
+        
+        """
+        if self.fast_primordial:
+            from .primordial import map_packed
+            return map_packed(self, params_list, workers)
+        results = dict(self.imap(params_list, workers))
+        return [results[i] for i in range(len(results))]
+        
+    def imap(self, params_list, workers=None):
+        """
+        
+        Lazy version of map which yields (index, result) pairs as runs finish. 
+        params_list is consumed lazily, so it can be a generator of any length.
+        
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        workers = workers or self.workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(workers) as pool:
+            pending = {}
+            for i,params in enumerate(params_list):
+                pending[pool.submit(lambda p: self(**p), params)] = i
+                if len(pending) >= 2*workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done: yield pending.pop(f), f.result()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done: yield pending.pop(f), f.result()
+        
+    @_timed('apply_defaults')
     def _apply_defaults(self, params):
         """Get params after applying defaults and removing output files"""
         p = self.defaults.copy()
+        valid = self._get_valid_params()
+        if valid is not None: _validate(params, valid, self.defaults)
         p.update(params)
-        for k in self.output_names: p.pop(k,None)
+        for k in [k for k in p if k in self.output_names or _transfer_key.match(k)]: p.pop(k)
+        if 'outputs' in p or 'lmax' in p: _plan_outputs(p)
+        if not isinstance(p.get('transfer_redshift',''),str): _plan_redshifts(p)
         return p
 
-    def _get_tmp_files(self, p):
+    def _get_valid_params(self):
+        """
+        The parameters calls are checked against, as from get_valid_params plus those in the 
+        defaults, or None if calls aren't checked (see the validate option of load).
+        """
+        if self._valid_params is None:
+            validate, index = self.validate, os.path.join(os.path.dirname(os.path.abspath(__file__)),'camb_keys.json')
+            if validate is None: 
+                #the built-in CAMB, and its variants, come with an index of their parameters
+                validate = os.path.dirname(self.executable)==os.path.dirname(index) and os.path.exists(index)
+            if validate is False:
+                self._valid_params = False
+            elif validate is True and not os.path.exists(index):
+                raise Exception("camb4py was installed without an index of CAMB's parameters, so give validate the folder of CAMB's source code instead.")
+            else:
+                valid = dict(get_valid_params(validate) if isinstance(validate,str) else _read_valid_params(index))
+                for k in self.defaults: valid.setdefault(_index_key(k), None)
+                self._valid_params = valid
+        return self._valid_params or None
+        
+    def _get_output_keys(self, p):
+        """Get the ini keys of the output files CAMB will write for these parameters."""
         output_files = []
         if try_str2bool(p['get_scalar_cls']): output_files += ['scalar_output_file']
         if try_str2bool(p['get_vector_cls']): output_files += ['vector_output_file']
         if try_str2bool(p['get_tensor_cls']): output_files += ['tensor_output_file']
-        if try_str2bool(p['do_lensing']): output_files += ['lensed_output_file', 'lensed_output_file']
-        if try_str2bool(p['get_transfer']): output_files += ['transfer_filename(1)', 'transfer_matterpower(1)']
-        
-        output_files = {k:mktemp(suffix='_%s'%k) for k in output_files}
+        if try_str2bool(p['get_scalar_cls']) and try_str2bool(p['do_lensing']): 
+            output_files += ['lensed_output_file', 'lens_potential_output_file']
+        if try_str2bool(p['get_transfer']): 
+            for i in range(1,int(p.get('transfer_num_redshifts',1))+1):
+                output_files += ['transfer_filename(%i)'%i, 'transfer_matterpower(%i)'%i]
+        if 'camb4py_outputs' in p:
+            requested = p['camb4py_outputs'].split(',')
+            output_files = [k for k in output_files if self._output_name(k).split('(')[0] in requested]
+        return output_files
+    
+    def _output_name(self, key):
+        """
+        Get the name in the result of an output file, e.g. 'scalar' for 'scalar_output_file'. 
+        Transfer functions at redshifts after the first are called e.g. 'transfer(2)' until 
+        they're stacked together by _make_result.
+        """
+        m = _transfer_key.match(key)
+        if m and m.group(2)!='1': return '%s(%s)'%(self.output_names['transfer_%s(1)'%m.group(1)], m.group(2))
+        return self.output_names.get(key,key)
+
+    def _result_names(self, params):
+        """The names of the outputs the result of a run with params should have (before _make_result)."""
+        return [self._output_name(k) for k in self._get_output_keys(params)]
+    
+    def _get_tmp_files(self, p):
+        from tempfile import mktemp
+        output_files = {k:mktemp(suffix='_%s'%k) for k in self._get_output_keys(p)}
         param_file = mktemp(suffix='_param')
 
         return output_files, param_file
     
         
     def _call_camb(self, paramfile, result=None):
+        import subprocess
         if result is None: result = {}
+        cpus = self._take_cpus()
         try:
-            result['stdout'] = subprocess.check_output(['./%s'%os.path.basename(self.executable),paramfile],
-                                                       cwd=os.path.dirname(self.executable),
-                                                       stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            print('Warning: CAMB failed with exit code %s'%e.returncode)
-            result['stdout'] = e.output
+            with _timer('call_camb'), _affinity(cpus):
+                #in its own process group, so it can be killed along with anything it starts
+                proc = subprocess.Popen(['./%s'%os.path.basename(self.executable),paramfile],
+                                        cwd=os.path.dirname(self.executable),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+                with _watchdog(proc) as watch:
+                    try: result['stdout'], _ = proc.communicate()
+                    except BaseException:
+                        _kill(proc)
+                        proc.wait()
+                        raise
+        finally:
+            self._release_cpus(cpus)
+        watch.check()
+        if proc.returncode: print('Warning: CAMB failed with exit code %s'%proc.returncode)
         result['misc'] = self._parse_stdout(result['stdout'])
         return result
 
+    @_timed('parse_outputs')
+    def _parse_output(self, data):
+        try: return self.parser(data)
+        except Exception: return _parse_loadtxt(data)
+
+    @_timed('write_ini')
     def _write_ini(self, p, file):
-        file.write('\n'.join(['%s = %s'%(k,try_bool2str(v)) for (k,v) in list(p.items())]+['END','']))
+        file.write('\n'.join(['%s = %s'%(k,try_bool2str(v)) for (k,v) in list(p.items()) if k not in _plan_keys]+['END','']))
 
+    @_timed('parse_stdout')
     def _parse_stdout(self,stdout):
         parsed = {}
         for line in stdout.splitlines():
@@ -118,114 +825,658 @@ class camb(object):
 class camb_disk(camb):
     """Implementation of CAMB which uses regular files on disk for communication."""
 
-    def __call__(self, **params):
-        """
-        
-        Call CAMB and return the output files as well as stdout. 
-        
-        Parameters
-        ----------
-        
-        **params : all key value pairs are passed to the CAMB ini
-        
-        """
-        params = self._apply_defaults(params)
-        
+    def _run(self, params):
         output_files, param_file = self._get_tmp_files(params)
-        for (key,filename) in list(output_files.items()): params[key]=filename
-        with open(param_file,'w') as f: self._write_ini(params, f)
-        
-        result = self._call_camb(param_file)
-        
-        for key,filename in list(output_files.items()):
-            rkey = self.output_names.get(key,key)
-            try: result[rkey] = loadtxt(filename)
-            except Exception as e: result[rkey] = e
+        try:
+            for (key,filename) in list(output_files.items()): params[key]=filename
+            with open(param_file,'w') as f: self._write_ini(params, f)
             
-            try: os.remove(filename)
-            except: pass
+            result = self._call_camb(param_file)
             
-        try: os.remove(param_file)
-        except: pass
+            for key,filename in list(output_files.items()):
+                rkey = self._output_name(key)
+                try: 
+                    with open(filename,'rb') as f: result[rkey] = self._parse_output(f.read())
+                except Exception as e: result[rkey] = e
+            return result
         
-        return result
+        finally:
+            for filename in list(output_files.values())+[param_file]:
+                try: os.remove(filename)
+                except OSError: pass
 
 
 
 class camb_pipe(camb):
-    """Implementation of CAMB which uses Unix named FIFO pipes for communication."""
+    """
+    Implementation of CAMB which uses Unix named FIFO pipes for communication.
     
-    def __call__(self, **params):
-        """
-        
-        Call CAMB and return the output files as well as std-out. 
-        
-        Parameters
-        ----------
-        
-        **params : all key value pairs are passed to the CAMB ini
-        
-        """
-        params = self._apply_defaults(params)
-        
+    All of the output FIFOs are read at once as CAMB writes them, in whatever order
+    it does so, and the rows are parsed as they arrive, so that by the time CAMB 
+    exits there is little left to do.
+    """
+    
+    def _run(self, params):
         output_files, param_file = self._get_tmp_files(params)
         for key,filename in list(output_files.items()): 
             params[key]=filename
             os.mkfifo(filename)
         os.mkfifo(param_file) 
         
-        result = {}
+        outputs = {}
+        try:
+            incremental = self.parser is parse_output
+            for key,filename in output_files.items():
+                outputs[key] = _fifo_output(filename, _expected_rows(key,params) if incremental else None)
+            
+            def writeparams():
+                try:
+                    with open(param_file,'w') as f: self._write_ini(params, f) 
+                except BrokenPipeError:
+                    pass
+            
+            camb_done = os.pipe()
+            wp_thread = _timed_thread(writeparams)
+            ro_thread = _timed_thread(_read_fifos,outputs,camb_done[0])
+            wp_thread.start()
+            ro_thread.start()
+            
+            try:
+                result = self._call_camb(param_file)
+            finally:
+                os.write(camb_done[1], b'x')
+                ro_thread.join()
+                for fd in camb_done: os.close(fd)
+                if wp_thread.is_alive():
+                    #CAMB never read its parameters, so unblock the writer
+                    os.close(os.open(param_file, os.O_RDONLY | os.O_NONBLOCK))
+                wp_thread.join()
+                for thread in [wp_thread, ro_thread]: _merge_timings(thread.timings)
+            
+            for key,output in outputs.items():
+                rkey = self._output_name(key)
+                if not output.nbytes: result[rkey] = _no_output(key)
+                else:
+                    try: result[rkey] = output.finish(self._parse_output)
+                    except Exception as e: result[rkey] = e
+            return result
+        
+        finally:
+            for output in outputs.values(): output.close()
+            for filename in list(output_files.values())+[param_file]: 
+                try: os.unlink(filename)
+                except OSError: pass
+
+
+
+def _no_output(key):
+    """The error in place of an output CAMB didn't write anything to, like the one a missing file gives."""
+    return IOError("CAMB didn't write anything to its %s"%key)
+
+
+def _timed_thread(target, *args):
+    """
+    A thread running target(*args) in a copy of the current context, but adding to timings of its
+    own (its attribute timings), since the call's mustn't be updated from two threads at once.
+    """
+    timings = {}
+    def run():
+        _timings.set(timings)
+        target(*args)
+    thread = Thread(target=copy_context().run, args=(run,))
+    thread.timings = timings
+    return thread
+
+def _merge_timings(timings):
+    """Add timings, e.g. those of a _timed_thread once it's joined, to the current call's."""
+    total = _timings.get()
+    if total is not None:
+        for k,v in timings.items(): total[k] = total.get(k,0) + v
+
+
+#how long to wait before checking again for output on a FIFO which gave EOF before anything
+#was written to it, doubling up to the maximum each time
+_fifo_retry, _max_fifo_retry = 0.01, 0.2
+
+def _read_fifos(outputs, camb_done):
+    """
+    Read from all of the output FIFOs whenever they are ready, until something is 
+    written to the camb_done file descriptor, after which whatever is left is drained.
+    """
+    import selectors
+    selector = selectors.DefaultSelector()
+    selector.register(camb_done, selectors.EVENT_READ)
+    for output in outputs.values(): selector.register(output.fd, selectors.EVENT_READ, output)
+    #some systems give EOF before CAMB has opened a FIFO, and keep giving it until it does, 
+    #so these are left out of the select until it's time to try them again
+    idle, retry, retry_at = [], _fifo_retry, None
+    while True:
+        events = selector.select(timeout=None if retry_at is None else max(retry_at - time.monotonic(), 0))
+        if any(key.fileobj==camb_done for key,_ in events): break
+        for key,_ in events:
+            output = key.data
+            if not output.read():
+                selector.unregister(output.fd)
+                if not output.nbytes: idle.append(output)
+        if retry_at is not None and time.monotonic() >= retry_at:
+            for output in idle: selector.register(output.fd, selectors.EVENT_READ, output)
+            idle, retry, retry_at = [], min(2*retry, _max_fifo_retry), None
+        if idle and retry_at is None: retry_at = time.monotonic() + retry
+    selector.close()
+    for output in outputs.values(): output.read()
+    
+    
+class _fifo_output(object):
+    """
+    One output FIFO which is read without blocking. If expected_rows is given, 
+    complete lines are parsed as they arrive into a preallocated array with room 
+    for that many rows, which is grown if needed.
+    """
+    
+    def __init__(self, filename, expected_rows=None):
+        self.fd = os.open(filename, os.O_RDONLY | os.O_NONBLOCK)
+        self.chunks, self.nbytes, self.pending = [], 0, b''
+        self.incremental = expected_rows is not None
+        self.expected_rows, self.buffer, self.nrows = expected_rows, None, 0
+        
+    def read(self):
+        """Read whatever is available, returning False on EOF."""
+        while True:
+            try: chunk = os.read(self.fd, 2**16)
+            except BlockingIOError: return True
+            if not chunk: return False
+            self.chunks.append(chunk)
+            self.nbytes += len(chunk)
+            if self.incremental: self._parse(chunk)
+            
+    def _parse(self, chunk):
+        data = self.pending + chunk
+        end = data.rfind(b'\n')+1
+        self.pending = data[end:]
+        if not end: return
+        try:
+            with _timer('parse_outputs'): rows = parse_output(data[:end])
+        except ValueError:
+            self.incremental = False
+            return
+        if self.buffer is None: 
+            from numpy import empty
+            self.buffer = empty((max(self.expected_rows,len(rows)),rows.shape[1]))
+        elif rows.shape[1]!=self.buffer.shape[1]: 
+            self.incremental = False
+            return
+        if self.nrows+len(rows) > len(self.buffer): 
+            self.buffer.resize((max(2*len(self.buffer),self.nrows+len(rows)),self.buffer.shape[1]), refcheck=False)
+        self.buffer[self.nrows:self.nrows+len(rows)] = rows
+        self.nrows += len(rows)
+        
+    def finish(self, parse):
+        """Get the output array, using parse on the whole contents if it couldn't be parsed as it came in."""
+        if self.incremental and self.pending.strip(): self._parse(b'\n')
+        if self.incremental and self.buffer is not None:
+            if self.nrows < len(self.buffer): self.buffer.resize((self.nrows,self.buffer.shape[1]), refcheck=False)
+            return self.buffer
+        return parse(b''.join(self.chunks))
         
-        def writeparams():
-            with open(param_file,'w') as f: self._write_ini(params, f) 
+    def close(self):
+        if self.fd is not None: 
+            os.close(self.fd)
+            self.fd = None
+            
+            
+def _expected_rows(key, params):
+    """Guess how many rows CAMB will write to an output, for preallocating space."""
+    try:
+        if key.startswith('tensor'): return int(params['l_max_tensor'])-1
+        elif key.startswith('transfer'): return 512
+        else: return int(params['l_max_scalar'])-1
+    except (KeyError, ValueError):
+        return 1024
+
+
+
+
+
+def _plan_outputs(p):
+    """
+    Replace the outputs and lmax requests in params with the CAMB switches and l_max's which 
+    give just those, and record them under _plan_keys for _get_output_keys and _make_result.
+    """
+    outputs, lmax = p.pop('outputs',None), p.pop('lmax',None)
+    if outputs is not None:
+        outputs = sorted(set(outputs.split(',') if isinstance(outputs,str) else outputs))
+        unknown = [o for o in outputs if o not in _output_switches]
+        if unknown: raise ValueError("Unknown outputs %s, expected some of %s"%(unknown,list(_output_switches)))
+        for switch in ['get_scalar_cls','get_vector_cls','get_tensor_cls','get_transfer','do_lensing']:
+            p[switch] = any(switch in _output_switches[o] for o in outputs)
+        p['camb4py_outputs'] = ','.join(outputs)
+    if lmax is not None:
+        lmax = int(lmax)
+        if outputs is None: lensed = try_str2bool(p.get('get_scalar_cls')) and try_str2bool(p.get('do_lensing'))
+        else: lensed = 'lensed' in outputs
+        p['l_max_scalar'] = lmax + (_lensing_margin if lensed is True else 0)
+        p['l_max_tensor'] = lmax
+        p['camb4py_lmax'] = lmax
         
-        def readoutputs(readany):
-            ro_started.set()
-            for key in output_files:
-                with open(params[key]) as f:
-                    read_any[0]=True
-                    try: result[self.output_names[key]] = loadtxt(f)
-                    except Exception: pass
+def _plan_redshifts(p):
+    """Turn a list of redshifts given as transfer_redshift into CAMB's transfer_redshift(i) in decreasing order."""
+    redshifts = sorted((float(z) for z in p.pop('transfer_redshift')), reverse=True)
+    for k in [k for k in p if k.startswith('transfer_redshift(')]: p.pop(k)
+    p['transfer_num_redshifts'] = len(redshifts)
+    for i,z in enumerate(redshifts): p['transfer_redshift(%i)'%(i+1)] = z
+    
+def _stack_redshifts(result, params):
+    """Stack the transfer outputs at each redshift into arrays of shape (n_z, n_k, n_cols), and add the redshifts."""
+    from numpy import ndarray, array, stack
+    n = int(params['transfer_num_redshifts'])
+    for name in ['transfer','transfer_matterpower']:
+        keys = [name] + ['%s(%i)'%(name,i) for i in range(2,n+1)]
+        if not all(isinstance(result.get(k),ndarray) for k in keys): continue
+        if len(set(result[k].shape for k in keys))>1:
+            print("Warning: %s outputs have different shapes at each redshift, so weren't stacked."%name)
+            continue
+        result[name] = stack([result.pop(k) for k in keys])
+    result['transfer_redshifts'] = array([float(params.get('transfer_redshift(%i)'%i,'nan')) for i in range(1,n+1)])
+
+def _trim_lmax(result, lmax):
+    """Drop the rows of Cl outputs beyond lmax (without copying)."""
+    from numpy import ndarray
+    for k in ['scalar','vector','tensor','lensed','lens_potential']:
+        v = result.get(k)
+        if isinstance(v,ndarray) and v.ndim==2: result[k] = v[:v[:,0].searchsorted(lmax,'right')]
+
+
+def fisher(jacobian, cov):
+    """
+    
+    Compute a Fisher matrix from the derivatives returned by camb.jacobian.
+    
+    Parameters
+    ----------
+    
+    jacobian : array of shape (n_params, n_rows, n_cols) for one output, e.g. 
+               camb.jacobian(...)['scalar']. The first (l or k) column is ignored.
+               
+    cov : the noise covariance of the remaining n_cols-1 columns, with shape either
+          (n_rows, n_cols-1) for a diagonal covariance at each row, 
+          (n_rows, n_cols-1, n_cols-1) for a covariance between columns at each row, or
+          (n_rows*(n_cols-1), n_rows*(n_cols-1)) for a full covariance
+          
+    Returns
+    -------
+    (n_params, n_params) Fisher matrix
+    
+    """
+    from numpy import asarray, einsum
+    from numpy.linalg import inv, solve
+    d, cov = asarray(jacobian)[:,:,1:], asarray(cov)
+    if cov.shape == d.shape[1:]:
+        return einsum('ila,la,jla->ij', d, 1/cov, d)
+    elif cov.ndim == 3:
+        return einsum('ila,lab,jlb->ij', d, inv(cov), d)
+    else:
+        d = d.reshape(d.shape[0],-1)
+        return d.dot(solve(cov, d.T))
 
-        wp_thread = Thread(target=writeparams)
-        wp_thread.start()
+class camb_shm(camb_disk):
+    """
+    
+    Implementation of CAMB which uses files in a RAM-backed scratch folder for communication. 
+    
+    Unlike camb_disk, the folder and the filenames in it are reused from call to call,
+    with one subfolder for each concurrent call (see camb.map), and outputs are read 
+    via mmap. The folder is removed by camb.close() or when the object is deleted.
+    
+    Parameters
+    ----------
+    
+    scratch, optional : folder in which to create the scratch folder, which should be 
+                        RAM-backed, e.g. tmpfs (default: /dev/shm if it exists, 
+                        otherwise the system temporary folder)
+    
+    """
+    
+    def __init__(self, executable=None, defaults=None, scratch=None, **kwargs):
+        from tempfile import mkdtemp, gettempdir
+        camb_disk.__init__(self, executable, defaults, **kwargs)
+        if scratch is None: scratch = '/dev/shm' if os.path.isdir('/dev/shm') else gettempdir()
+        self.scratch = mkdtemp(prefix='camb4py_', dir=scratch)
+        self._idle = Queue()
+        self._nslots = 0
+        self._lock = Lock()
+        
+    def _run(self, params):
+        slot = self._get_slot()
+        try:
+            output_files = {k:os.path.join(slot,k) for k in self._get_output_keys(params)}
+            for (key,filename) in output_files.items(): params[key]=filename
+            param_file = os.path.join(slot,'params.ini')
+            with open(param_file,'w') as f: self._write_ini(params, f)
+            
+            result = self._call_camb(param_file)
+            
+            for key,filename in output_files.items():
+                rkey = self._output_name(key)
+                try: result[rkey] = self._read_output(filename)
+                except Exception as e: result[rkey] = e
+            return result
+        finally:
+            #so a failed run can't pick up the outputs from the previous one
+            for filename in output_files.values():
+                try: os.remove(filename)
+                except OSError: pass
+            self._idle.put(slot)
+            
+    def _read_output(self, filename):
+        import mmap
+        with open(filename,'rb') as f:
+            if os.fstat(f.fileno()).st_size==0: return self._parse_output(b'')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m: 
+                return self._parse_output(m)
         
-        read_any = [False]
-        ro_started = Event()
-        ro_thread = Thread(target=readoutputs,args=(read_any,))
-        ro_thread.start()
-        ro_started.wait()
+    def _get_slot(self):
+        """Get a subfolder of the scratch folder which no other call is using."""
+        try: 
+            return self._idle.get_nowait()
+        except Empty:
+            with self._lock:
+                self._nslots += 1
+                slot = os.path.join(self.scratch,str(self._nslots))
+            os.mkdir(slot)
+            return slot
+            
+    def close(self):
+        """Remove the scratch folder."""
+        import shutil
+        shutil.rmtree(self.scratch, ignore_errors=True)
         
-        self._call_camb(param_file, result)
+    def __del__(self):
+        try: self.close()
+        except Exception: pass
         
-        if read_any[0]:  
-            ro_thread.join()
-        else:
-            for key in output_files: open(params[key],'a').close()
         
-        for key in output_files: os.unlink(params[key])
-        os.unlink(param_file)
 
+class camb_server(camb_disk):
+    """
+    
+    Implementation of CAMB which keeps CAMB processes running between calls and 
+    sends them the names of successive parameter files over a pipe. Outputs are 
+    read from regular files as in camb_disk. 
+    
+    The executable must be a CAMB built with camb4py's server driver (src/camb4py_server.f90)
+    which is done automatically for the built-in CAMB. One process is kept for each 
+    concurrent call (see camb.map), and crashed processes are restarted on the next call.
+    
+    Parameters
+    ----------
+    
+    max_calls, optional : number of models a process runs before it's replaced by a 
+                          fresh one, to guard against any memory leaks in CAMB (default: 1000)
+    
+    """
+    
+    default_executable = 'camb_server'
+    
+    def __init__(self, executable=None, defaults=None, max_calls=1000, **kwargs):
+        camb_disk.__init__(self, executable, defaults, **kwargs)
+        self.max_calls = max_calls
+        self._idle = Queue()
+        self._closed = False
+        self._lock = Lock()
+        
+    def _call_camb(self, paramfile, result=None):
+        if result is None: result = {}
+        server = self._get_server()
+        stdout = []
+        with _timer('call_camb'), _watchdog(server) as watch:
+            try:
+                server.stdin.write(('%s\n'%os.path.abspath(paramfile)).encode())
+                server.stdin.flush()
+                for line in iter(server.stdout.readline, b''):
+                    if line.rstrip()==_server_sentinel: break
+                    stdout.append(line)
+                else:
+                    server.wait()
+            except (IOError, OSError):
+                _kill(server)
+                server.wait()
+        result['stdout'] = b''.join(stdout)
+        
+        if server.returncode is not None:
+            if not watch.killed: print('Warning: CAMB failed with exit code %s'%server.returncode)
+            self._release_cpus(server.cpus)
+        else:
+            server.ncalls += 1
+            #once closed, processes are stopped as their calls finish rather than kept
+            with self._lock:
+                keep = server.ncalls < self.max_calls and not self._closed
+                if keep: self._idle.put(server)
+            if not keep: self._stop(server)
+        watch.check()
+        result['misc'] = self._parse_stdout(result['stdout'])
         return result
+    
+    def _get_server(self):
+        """Get an idle and healthy CAMB process, starting a new one if needed."""
+        while True:
+            try: server = self._idle.get_nowait()
+            except Empty: break
+            if server.poll() is None: return server
+            self._release_cpus(server.cpus)
+        import subprocess
+        #each process keeps its CPUs for as long as it runs, if there are any free
+        cpus = self._take_cpus(block=False)
+        with _affinity(cpus):
+            server = subprocess.Popen(['./%s'%os.path.basename(self.executable)],
+                                      cwd=os.path.dirname(self.executable),
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      start_new_session=True)
+        server.ncalls, server.cpus = 0, cpus
+        return server
+    
+    def _stop(self, server):
+        try: 
+            server.stdin.close()
+            server.wait(timeout=5)
+        except Exception: 
+            server.kill()
+            server.wait()
+        self._release_cpus(server.cpus)
+        
+    def close(self):
+        """
+        Stop all of the running CAMB processes. Those running a model are stopped once it finishes, 
+        as are any started by later calls.
+        """
+        with self._lock: self._closed = True
+        while True:
+            try: self._stop(self._idle.get_nowait())
+            except Empty: break
+            
+    def __del__(self):
+        try: self.close()
+        except Exception: pass
 
 
+    
+def get_valid_params(sourcedir):
+    """
+    Scour the CAMB source files in sourcedir for the parameters CAMB reads from the ini file.
+    Returns a dict of {name: type}, with types 'int', 'float', 'bool', or 'string', and parameters 
+    which take an index, e.g. scalar_amp(1), listed as 'scalar_amp(i)'.
+    """
+    camb_keys = {}
+    for filename in os.listdir(sourcedir):
+        if filename.lower().endswith(('.f90','.f')):
+            with open(os.path.join(sourcedir,filename), errors='replace') as f:
+                for m in _ini_read.finditer(f.read()):
+                    key = m.group(3) + ('(i)' if m.group(2) else '')
+                    t = _ini_types[m.group(1).lower()]
+                    #parameters read as more than one type are only checked as strings
+                    camb_keys[key] = t if camb_keys.get(key,t)==t else 'string'
+    return camb_keys
 
+@lru_cache()
+def _read_valid_params(filename):
+    import json
+    with open(filename) as f: return json.load(f)
 
+def _index_key(key):
+    """e.g. 'scalar_amp(i)' for 'scalar_amp(1)', as parameters which take an index are listed by get_valid_params."""
+    m = _indexed_param.match(key)
+    return '%s(i)'%m.group(1) if m else key
 
+def _validate(params, valid, defaults):
+    """
+    Raise a ValueError listing any of params which CAMB doesn't read, have a malformed index, 
+    or have a value of the wrong type, given valid from camb._get_valid_params.
+    """
+    problems = []
+    for k,v in params.items():
+        if k in _request_params or k.startswith('camb4py_') or (k in defaults and v is defaults[k]): continue
+        m = _indexed_param.match(k)
+        if m:
+            if not m.group(2).isdigit() or int(m.group(2))<1: 
+                problems.append("'%s' should have a positive integer index, e.g. '%s(1)'"%(k,m.group(1)))
+                continue
+            if m.group(1) in valid and '%s(i)'%m.group(1) not in valid:
+                problems.append("'%s' doesn't take an index, use '%s'"%(k,m.group(1)))
+                continue
+            key = '%s(i)'%m.group(1)
+        elif k not in valid and '%s(i)'%k in valid:
+            if k=='transfer_redshift' and not isinstance(v,str): 
+                if not all(_valid_value(valid[k+'(i)'], z) for z in v): problems.append("'%s' should be a list of numbers"%k)
+            else: problems.append("'%s' needs an index, e.g. '%s(1)'"%(k,k))
+            continue
+        else:
+            key = k
+        if key not in valid:
+            from difflib import get_close_matches
+            close = get_close_matches(k, [c.replace('(i)','(1)') for c in valid], 1)
+            problems.append("'%s' isn't a CAMB parameter%s"%(k, " (did you mean '%s'?)"%close[0] if close else ''))
+        elif not _valid_value(valid[key], v):
+            problems.append("'%s' should be of type %s, got %r"%(k,valid[key],v))
+    if problems: 
+        raise ValueError("Invalid CAMB parameters (pass validate=False to load to skip this check):\n * "+'\n * '.join(problems))
+
+def _valid_value(type, value):
+    value = str(try_bool2str(value)).strip()
+    try:
+        if type=='int': int(value)
+        elif type=='float': float(value.replace('d','e').replace('D','e'))
+        elif type=='bool': return value.lstrip('.')[:1].upper() in ('T','F')
+    except ValueError: 
+        return False
+    return True
+
+
+def parse_output(data):
+    """
     
-def get_valid_params(self, sourcedir):
-    """Scour CAMB source files for valid parameters"""
-    camb_keys=set()
-    for f in os.listdir('.'):
-        if f.endswith('90'):
-            with open(f) as f:
-                for line in f:
-                    r = re.search("Ini_Read.*File\(.*?,'(.*)'",line,re.IGNORECASE)
-                    if r: camb_keys.add(r.group(1))
-                    r = re.search("Ini_Read.*\('(.*)'",line,re.IGNORECASE)
-                    if r: camb_keys.add(r.group(1))    
-                    
-    return camb_keys
+    Parse the contents of a CAMB output file (bytes, or e.g. an mmap) into an array. 
+    
+    CAMB writes its outputs with a fixed Fortran format, so every line has the same
+    length and each column has its digits, decimal point, and exponent at the same
+    place on every line. The columns are then decoded all at once straight from the
+    bytes, which is faster than numpy.loadtxt. Files which don't fit this layout, 
+    or are too small for this to pay off, are instead split on whitespace and 
+    converted in one go. 
+    
+    """
+    from numpy import array
+    if isinstance(data,str): data = data.encode()
+    if data[:1]==b'#': data = bytes(data)
+    while data.startswith(b'#'): data = data.partition(b'\n')[2]
+    try: 
+        if len(data) < _min_fixed_width_bytes: raise ValueError
+        return _parse_fixed_width(data)
+    except ValueError:
+        data = bytes(data)
+        ncols = len(data.partition(b'\n')[0].split())
+        values = array(data.split(), dtype=float)
+        if ncols==0 or len(values)%ncols: raise ValueError("CAMB output doesn't have a fixed number of columns")
+        return values.reshape(-1,ncols)
+    
+#below about this size, the fixed cost of the dozen or so array operations is more than splitting takes
+_min_fixed_width_bytes = 8192
+
+def _parse_fixed_width(data):
+    """Parse a file where every line has the same length and layout, raising ValueError otherwise."""
+    from numpy import frombuffer, uint8, where
+    width = data.find(b'\n')+1
+    if width<=1 or len(data)%width: raise ValueError
+    chars = frombuffer(data, dtype=uint8).reshape(-1,width)
+    layout = _fixed_width_layout(bytes(data[:width]).translate(_zero_digits).decode())
+    
+    #check every line has the same layout as the first
+    if ((chars<layout['lo']) | (chars>layout['hi'])).any(): raise ValueError
+    digits = chars - uint8(ord('0'))
+    isdigit = digits<=9
+    if not (isdigit[:,layout['int']] | (chars[:,layout['int']]==ord(' '))).all(): raise ValueError
+    
+    #decode all columns at once, the products and sums here involve only small integers so are exact
+    values = (digits*isdigit).astype(float).dot(layout['weights'])
+    mantissa, exponent = values[:,:values.shape[1]//2], values[:,values.shape[1]//2:]
+    exponent = where(chars[:,layout['exp_sign']]==ord('-'),-1,1) * exponent - layout['nfrac']
+    sign = where(chars[:,layout['sign']]==ord('-'),-1.,1.)
+    #dividing or multiplying an exact integer mantissa by an exact power of ten rounds correctly
+    if (abs(exponent)>22).any(): raise ValueError
+    return sign * where(exponent<0, mantissa / 10.**abs(exponent), mantissa * 10.**abs(exponent))
+
+#turns every digit into a 0, so lines with the same layout look the same
+_zero_digits = bytes.maketrans(b'0123456789', b'0'*10)
+
+@lru_cache(maxsize=64)
+def _fixed_width_layout(line):
+    """
+    Work out where the digits, signs, etc... of each column are, given the first line of a file.
+    The allowed characters at each position are given by the range lo to hi, and the weights
+    turn digits into the mantissa and exponent of each column.
+    """
+    from numpy import array, uint8, zeros, arange, hstack
+    width, tokens = len(line), list(re.finditer(r'\S+', line))
+    lo, hi = array([ord(c) for c in line], dtype=uint8), array([ord(c) for c in line], dtype=uint8)
+    mantissa_weights, exp_weights = zeros((width,len(tokens))), zeros((width,len(tokens)))
+    layout = {'int':[], 'sign':[], 'exp_sign':[], 'nfrac':[]}
+    
+    def digits(positions, weights, i):
+        lo[positions], hi[positions] = ord('0'), ord('9')
+        weights[positions,i] = 10.**arange(len(positions)-1,-1,-1)
+        
+    for i,t in enumerate(tokens):
+        start = tokens[i-1].end() if i else 0
+        m = re.match(r'(-?)(\d*)(?:(\.)(\d*))?(?:([eE])([+-])(\d+))?$', t.group())
+        if m is None or not (m.group(2) or m.group(4)): raise ValueError
+        pos = lambda g: list(range(t.start()+m.start(g),t.start()+m.end(g)))
+        sign, _, dot, fracpart, e, esign, _ = m.groups()
+        
+        #the newline at the end of each line stands in for the sign of unsigned columns
+        layout['sign'].append(width-1)
+        layout['exp_sign'].append(width-1)
+        layout['nfrac'].append(len(fracpart or ''))
+        
+        if dot is None and e is None:
+            #integer column, right aligned so larger numbers spill into the leading blanks
+            if sign: raise ValueError
+            digits(list(range(start,t.end())), mantissa_weights, i)
+            lo[start:t.end()], hi[start:t.end()] = ord(' '), ord('9')
+            layout['int'] += range(start,t.end())
+        else:
+            #the sign goes where the '-' is on the first line, or else just before the number
+            if sign or t.start()>start:
+                layout['sign'][-1] = t.start() - (not sign)
+                lo[layout['sign'][-1]], hi[layout['sign'][-1]] = ord(' '), ord('-')
+            digits(pos(2)+pos(4), mantissa_weights, i)
+            if esign:
+                layout['exp_sign'][-1] = t.start()+m.start(6)
+                lo[layout['exp_sign'][-1]], hi[layout['exp_sign'][-1]] = ord('+'), ord('-')
+                digits(pos(7), exp_weights, i)
+                
+    layout.update({k:array(v,dtype=int) for k,v in layout.items()})
+    layout.update(lo=lo, hi=hi, weights=hstack([mantissa_weights,exp_weights]))
+    return layout
 
 
 def try_bool2str(value):
@@ -241,20 +1492,35 @@ def try_str2bool(value):
 
     
 def read_ini(ini):
-    """Load an ini file or string into a dictionary."""
+    """
+    Load an ini file or string into a dictionary. The built-in defaults are already
+    parsed, and files are only parsed again if they've been modified since last time.
+    """
     if isinstance(ini,dict): return ini
     if isinstance(ini,str):
-        if os.path.exists(ini): ini = open(ini).read()
-        config = RawConfigParser()
-        config.optionxform=str
-        config.readfp(StringIO(u'[root]\n'+ini))
-        return dict(config.items('root'))
+        if ini is _defaults: return dict(_default_params)
+        if os.path.exists(ini): 
+            st = os.stat(ini)
+            return dict(_read_ini_file(os.path.abspath(ini), st.st_mtime_ns, st.st_size))
+        return dict(_parse_ini(ini))
     else:
         raise ValueError('Unexpected type for ini file %s'%type(ini))
         
+@lru_cache(maxsize=64)
+def _read_ini_file(filename, mtime, size):
+    with open(filename) as f: return _parse_ini(f.read())
+
+@lru_cache(maxsize=64)
+def _parse_ini(ini):
+    from configparser import RawConfigParser
+    config = RawConfigParser()
+    config.optionxform=str
+    config.read_string(u'[root]\n'+ini)
+    return dict(config.items('root'))
+        
 
-def get_default_executable():
-    camb_exec = os.path.join(os.path.dirname(os.path.abspath(__file__)),'camb')
+def get_default_executable(name='camb'):
+    camb_exec = os.path.join(os.path.dirname(os.path.abspath(__file__)),name)
     if os.path.exists(camb_exec): return camb_exec
     else: return None
 
@@ -262,6 +1528,51 @@ def get_default_executable():
 
 
 
+_server_sentinel = b'CAMB4PY_DONE'
+
+
+
+def _parse_loadtxt(data):
+    from numpy import loadtxt
+    return loadtxt(bytes(data).decode().splitlines())
+
+_parsers = {'fast':parse_output, 
+            'loadtxt':_parse_loadtxt}
+
+
+
+_stencils = {'forward':((0,1),(-1,1)),
+             'central':((-1,1),(-.5,.5)),
+             'five-point':((-2,-1,1,2),(1/12.,-8/12.,8/12.,-1/12.))}
+
+
+
+#the switches needed for each of the outputs which can be requested with outputs=[...]
+_output_switches = {'scalar':['get_scalar_cls'],
+                    'vector':['get_vector_cls'],
+                    'tensor':['get_tensor_cls'],
+                    'lensed':['get_scalar_cls','do_lensing'],
+                    'lens_potential':['get_scalar_cls','do_lensing'],
+                    'transfer':['get_transfer'],
+                    'transfer_matterpower':['get_transfer']}
+
+#CAMB computes lensed Cl's up to this many multipoles short of l_max_scalar
+_lensing_margin = 100
+
+#the transfer function and matter power output files at each redshift
+_transfer_key = re.compile(r'transfer_(filename|matterpower)\((\d+)\)$')
+
+#keys added to params by _plan_outputs, which aren't passed on to CAMB
+_plan_keys = ['camb4py_outputs','camb4py_lmax']
+
+#parameters of calls which are requests to camb4py rather than CAMB parameters
+_request_params = ['outputs','lmax']
+
+#Ini_Read_Double('ombh2'), Ini_Read_Double_Array_File(Ini,'scalar_amp',i), Ini%Read_Logical('do_lensing'), etc.
+_ini_read = re.compile(r"""(?:Ini_|%)Read_(Int|Double|Real|Logical|String)(_Array)?\w*\s*\(\s*(?:\w+\s*,\s*)?['"]([^'"]+)['"]""", re.I)
+_ini_types = {'int':'int', 'double':'float', 'real':'float', 'logical':'bool', 'string':'string'}
+_indexed_param = re.compile(r'(\w+)\((.*)\)$')
+
 _output_names = {'scalar_output_file':'scalar',
                  'vector_output_file':'vector',
                  'tensor_output_file':'tensor',
@@ -497,4 +1808,18 @@ l_accuracy_boost        = 1
 #interpolation errors may be up to 3%
 #Decrease to speed up non-flat models a bit
 l_sample_boost          = 1
-"""
\ No newline at end of file
+"""
+
+
+#_defaults already parsed, so that loading with the default parameters doesn't need configparser. 
+#its plain 'key = value' lines don't need anything more than this
+def _parse_plain_ini(ini):
+    params = {}
+    for line in ini.splitlines():
+        line = line.strip()
+        if line and line[0] not in '#;':
+            k, _, v = line.partition('=')
+            params[k.strip()] = v.strip()
+    return params
+
+_default_params = _parse_plain_ini(_defaults)
@@ -0,0 +1,412 @@
+"""
+
+Running CAMB on many machines at once.
+
+A camb_distributed object (from camb4py.load(protocol='distributed')) acts as a broker:
+it listens on a socket, and any number of workers, started on other machines with ::
+
+    python -m camb4py worker --connect host:port
+
+connect to it and run the models it is asked for with their own local CAMB. Workers
+pull tasks as they have free CAMB processes, so faster machines take more of the work,
+and the tasks of a worker which disconnects or dies are given to the others. Since idle
+workers pull from the one queue on the broker, rather than each having its own queue,
+there is never a backlog on a busy worker for the others to steal from.
+
+Messages are a JSON header followed by the raw bytes of any arrays, so results are
+sent without going through text.
+
+"""
+
+import os, time, json, socket, struct
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Thread, Lock, Condition, Semaphore
+from numpy import ndarray, frombuffer, prod
+from .camb4py import camb, load, _timer, _control, _call_control, _cancelled
+
+
+class camb_distributed(camb):
+    """
+
+    Implementation of CAMB which sends each model to one of the workers connected to it.
+
+    Parameters
+    ----------
+
+    address, optional : where to listen for workers, either a (host, port) tuple or 'host:port'
+                        string for TCP, or a filename for a Unix socket. port 0 picks a free port,
+                        and the address actually used is in the attribute address
+                        (default: ('127.0.0.1', 0), i.e. only workers on this machine)
+
+    max_pending, optional : the most models which can be queued or running at once. calls
+                            beyond this block until others finish (default: 256)
+
+    retries, optional : how many times a model is re-sent after the worker running it was
+                        lost, before giving up on it (default: 3)
+
+    worker_wait, optional : how many seconds a model waits for a worker to connect while none
+                            are, before failing with a TimeoutError. None waits forever
+                            (default: 300)
+
+    The executable argument of load is ignored, since each worker uses its own.
+
+    """
+
+    def __init__(self, executable=None, defaults=None, address=('127.0.0.1',0), max_pending=256, retries=3, worker_wait=300, **kwargs):
+        self.max_pending = max_pending
+        self.retries = retries
+        self.worker_wait = worker_wait
+        self._listener = _listen(address)
+        self.address = self._listener.getsockname()
+        super(camb_distributed,self).__init__(executable, defaults, **kwargs)
+        self._queue = deque()
+        self._cond = Condition()
+        self._slots = Semaphore(max_pending)
+        self._next_id = 0
+        self._workers = set()
+        self._workerless_since = time.monotonic()
+        self._closed = False
+        Thread(target=self._accept, daemon=True).start()
+
+    def _find_executable(self, executable):
+        return 'distributed:%s'%(self.address if isinstance(self.address,str) else '%s:%s'%self.address[:2])
+
+    @property
+    def nworkers(self):
+        """The number of CAMB processes across all of the connected workers."""
+        with self._cond: return sum(w.slots for w in self._workers)
+
+    def imap(self, params_list, workers=None):
+        """Like camb.imap, but by default keeping up to max_pending models going at once."""
+        return super(camb_distributed,self).imap(params_list, workers or self.max_pending)
+
+    def _run(self, params):
+        control = _control.get()
+        with self._slots:
+            future = Future()
+            with self._cond:
+                if self._closed: raise Exception("This camb_distributed object has been closed.")
+                self._next_id += 1
+                task = _task(self._next_id, params, future)
+                self._queue.append(task)
+                self._cond.notify_all()
+            queued = time.monotonic()
+            with _timer('call_camb'):
+                while True:
+                    _wait(future, control, self._worker_deadline(queued))
+                    if future.done(): return future.result()
+                    if control is not None and (control.cancelled or _expired(control)):
+                        self._abandon(task)
+                        if control.cancelled: raise _cancelled()
+                        raise TimeoutError("CAMB didn't finish within %g seconds and was killed"%control.timeout)
+                    remaining = self._worker_deadline(queued)
+                    if remaining is not None and remaining <= 0:
+                        self._abandon(task)
+                        raise TimeoutError("No workers connected to %s within %g seconds to run this model."
+                                           %(self.executable.split(':',1)[1], self.worker_wait))
+
+    def _worker_deadline(self, queued):
+        """Seconds left before a model queued at time queued gives up waiting for a worker, or None."""
+        if self.worker_wait is None: return None
+        with self._cond:
+            if self._workers: return self.worker_wait
+            return max(queued, self._workerless_since) + self.worker_wait - time.monotonic()
+
+    def _abandon(self, task):
+        """Take a task off the queue, or tell the worker running it to kill it."""
+        with self._cond:
+            if task in self._queue: 
+                self._queue.remove(task)
+                return
+            for w in self._workers:
+                if w.running.pop(task.id, None) is not None: break
+            else: 
+                return
+            self._cond.notify_all()
+        try: w.send({'type':'cancel', 'id':task.id})
+        except OSError: pass
+
+    def _accept(self):
+        while True:
+            try: sock, _ = self._listener.accept()
+            except OSError: return
+            Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        """Send tasks to one worker and collect its results, until it disconnects."""
+        try: hello, _ = _recv(sock)
+        except (OSError, ValueError):
+            sock.close()
+            return
+        w = _worker_connection(sock, hello.get('slots',1))
+        with self._cond:
+            if self._closed:
+                sock.close()
+                return
+            self._workers.add(w)
+        Thread(target=self._dispatch, args=(w,), daemon=True).start()
+        try:
+            while True:
+                header, arrays = _recv(sock)
+                with self._cond:
+                    task = w.running.pop(header['id'], None)
+                    self._cond.notify_all()
+                if task is None: continue
+                if header['type']=='error': task.future.set_exception(Exception(header['message']))
+                else: task.future.set_result(_decode_result(header, arrays))
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            self._lost(w)
+
+    def _dispatch(self, w):
+        """Hand queued tasks to a worker whenever it has a free CAMB process."""
+        while True:
+            with self._cond:
+                while w.alive and not self._closed and (not self._queue or len(w.running) >= w.slots):
+                    self._cond.wait()
+                if not w.alive or self._closed: return
+                task = self._queue.popleft()
+                w.running[task.id] = task
+            try: w.send({'type':'task', 'id':task.id, 'params':task.params})
+            except OSError:
+                self._lost(w)
+                return
+
+    def _lost(self, w):
+        """Put the tasks of a worker which has gone away back on the queue."""
+        with self._cond:
+            if not w.alive: return
+            w.alive = False
+            self._workers.discard(w)
+            if not self._workers: self._workerless_since = time.monotonic()
+            for task in w.running.values():
+                task.attempts += 1
+                if task.attempts > self.retries or self._closed:
+                    task.future.set_exception(Exception("Lost the worker running this model %i times."%task.attempts))
+                else:
+                    self._queue.appendleft(task)
+            w.running.clear()
+            self._cond.notify_all()
+        try: w.sock.close()
+        except OSError: pass
+
+    def close(self):
+        """Stop listening, disconnect all workers, and fail any models which haven't finished."""
+        with self._cond:
+            if self._closed: return
+            self._closed = True
+            workers = list(self._workers)
+            while self._queue: self._queue.popleft().future.set_exception(Exception("camb_distributed was closed."))
+            self._cond.notify_all()
+        try: self._listener.close()
+        except OSError: pass
+        if isinstance(self.address,str):
+            try: os.remove(self.address)
+            except OSError: pass
+        for w in workers:
+            try: w.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+
+    def __del__(self):
+        try: self.close()
+        except: pass
+
+
+
+class _task(object):
+    __slots__ = ('id','params','future','attempts')
+
+    def __init__(self, id, params, future):
+        self.id, self.params, self.future, self.attempts = id, params, future, 0
+
+
+class _worker_connection(object):
+    def __init__(self, sock, slots):
+        self.sock, self.slots = sock, slots
+        self.running = {}
+        self.alive = True
+        self.send_lock = Lock()
+
+    def send(self, header):
+        with self.send_lock: _send(self.sock, header)
+
+
+def _wait(future, control, timeout=None):
+    """Wait for a future until it's done, the call's deadline passes or it's cancelled, or timeout seconds pass."""
+    end = None if timeout is None else time.monotonic() + timeout
+    if control is None:
+        wait([future], timeout)
+        return
+    def wake(_):
+        with control.cond: control.cond.notify_all()
+    future.add_done_callback(wake)
+    with control.cond:
+        while not future.done() and not control.cancelled:
+            remaining = [t - time.monotonic() for t in (control.deadline, end) if t is not None]
+            if remaining and min(remaining) <= 0: break
+            control.cond.wait(min(remaining) if remaining else None)
+
+
+def _expired(control):
+    return control.deadline is not None and control.deadline <= time.monotonic()
+
+
+
+def worker(address, executable=None, defaults=None, protocol='pipe', workers=None, connect_timeout=60, **kwargs):
+    """
+
+    Connect to a camb_distributed broker and run models for it until it disconnects.
+
+    Parameters
+    ----------
+
+    address : the broker's address, as a (host, port) tuple, 'host:port' string, or Unix socket filename
+
+    workers, optional : the number of CAMB processes to run at once (default: number of cores)
+
+    connect_timeout, optional : how many seconds to keep trying to connect, in case the broker
+                                hasn't started yet (default: 60)
+
+    executable, defaults, protocol, **kwargs : passed to camb4py.load to create the local CAMB,
+                                               e.g. timeout to kill models which get CAMB stuck
+
+    Models the broker gives up on (because its timeout passed, or a speculative duplicate 
+    finished first) are killed.
+
+    """
+    workers = workers or os.cpu_count() or 1
+    local = load(executable, defaults, protocol=protocol, **kwargs)
+    sock = _connect(address, connect_timeout)
+    send_lock = Lock()
+    controls = {}
+
+    def run(header):
+        control = controls[header['id']]
+        if control.cancelled: 
+            controls.pop(header['id'], None)
+            return
+        token = _control.set(control)
+        try:
+            result = local(**header['params'])
+            if hasattr(result,'to_dict'): result = result.to_dict()
+            reply, arrays = _encode_result(result)
+            reply.update(type='result', id=header['id'])
+        except _cancelled:
+            return
+        except Exception as e:
+            reply, arrays = {'type':'error', 'id':header['id'], 'message':'%s: %s'%(type(e).__name__,e)}, []
+        finally:
+            _control.reset(token)
+            controls.pop(header['id'], None)
+        try:
+            with send_lock: _send(sock, reply, arrays)
+        except OSError:
+            pass
+
+    try:
+        _send(sock, {'type':'hello', 'slots':workers})
+        #the broker never sends more tasks than we have slots, so the pool never queues much
+        with ThreadPoolExecutor(workers) as pool:
+            while True:
+                try: header, _ = _recv(sock)
+                except (OSError, ValueError): break
+                if header.get('type')=='task': 
+                    controls[header['id']] = _call_control()
+                    pool.submit(run, header)
+                elif header.get('type')=='cancel' and header['id'] in controls:
+                    controls[header['id']].cancel()
+    finally:
+        sock.close()
+
+
+
+def _parse_address(address):
+    """Get the socket family and address for a (host, port) tuple, 'host:port' string, or filename."""
+    if isinstance(address,str):
+        host, sep, port = address.rpartition(':')
+        if sep and port.isdigit(): return socket.AF_INET, (host or '127.0.0.1', int(port))
+        return socket.AF_UNIX, address
+    return socket.AF_INET, tuple(address)
+
+def _listen(address):
+    family, address = _parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family==socket.AF_INET: sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(128)
+    return sock
+
+def _connect(address, timeout=0):
+    family, address = _parse_address(address)
+    start = time.time()
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            break
+        except OSError:
+            sock.close()
+            if time.time() - start > timeout: raise
+            time.sleep(1)
+    if family==socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    return sock
+
+
+#each message is the lengths of the header and of the payload, the JSON header, and the payload
+_frame = struct.Struct('!II')
+
+def _send(sock, header, arrays=()):
+    header = json.dumps(header, default=str).encode()
+    sock.sendall(_frame.pack(len(header), sum(a.nbytes for a in arrays)) + header)
+    for a in arrays: sock.sendall(memoryview(a).cast('B'))
+
+def _recv(sock):
+    nheader, npayload = _frame.unpack(_recv_exactly(sock, _frame.size))
+    header = json.loads(bytes(_recv_exactly(sock, nheader)))
+    return header, _recv_exactly(sock, npayload)
+
+def _recv_exactly(sock, n):
+    buf = bytearray(n)
+    view, got = memoryview(buf), 0
+    while got < n:
+        m = sock.recv_into(view[got:])
+        if m==0: raise OSError("Connection closed")
+        got += m
+    return buf
+
+
+def _encode_result(result):
+    """Split a result into a JSON header and a list of contiguous arrays."""
+    header, arrays = {'arrays':[], 'other':{}}, []
+    for k,v in result.items():
+        if k=='timings': continue
+        if isinstance(v,ndarray):
+            v = v if v.flags.c_contiguous else v.copy()
+            header['arrays'].append((k, v.dtype.str, v.shape))
+            arrays.append(v)
+        elif isinstance(v,bytes):
+            header['arrays'].append((k, 'bytes', len(v)))
+            arrays.append(frombuffer(v,dtype='u1'))
+        elif isinstance(v,Exception):
+            header['other'][k] = {'exception':'%s: %s'%(type(v).__name__,v)}
+        else:
+            header['other'][k] = v
+    return header, arrays
+
+def _decode_result(header, payload):
+    result, offset = {}, 0
+    for k,v in header['other'].items():
+        result[k] = Exception(v['exception']) if isinstance(v,dict) and list(v)==['exception'] else v
+    for k,dtype,shape in header['arrays']:
+        if dtype=='bytes':
+            result[k] = bytes(payload[offset:offset+shape])
+            offset += shape
+        else:
+            a = frombuffer(payload, dtype=dtype, offset=offset, count=int(prod(shape))).reshape(shape)
+            result[k] = a
+            offset += a.nbytes
+    return result
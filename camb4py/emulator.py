@@ -0,0 +1,203 @@
+import json
+from itertools import combinations_with_replacement
+from numpy import array, asarray, ones, prod, sqrt, mean, where, allclose, savez_compressed, load as npload
+from numpy.linalg import svd, lstsq, pinv, norm
+from .camb4py import try_bool2str
+from .sweep import latin_hypercube
+
+#outputs whose rows are always the same multipoles, unlike the k's of the transfer outputs
+_cl_outputs = ['scalar', 'vector', 'tensor', 'lensed', 'lens_potential']
+
+
+class emulator(object):
+    """
+
+    A fast surrogate for a camb object in a region of parameter space.
+
+    The emulator is trained on CAMB runs at points filling the given parameter ranges.
+    Each output is compressed with PCA, and the PCA coefficients are fit with a
+    polynomial in the parameters, so predictions take well under a millisecond. Queries outside
+    the trained ranges, which change any other parameter, or whose estimated error is
+    above the tolerance, are passed on to CAMB instead.
+
+    Parameters
+    ----------
+
+    camb : a camb object (from camb4py.load) used for training and as a fallback
+
+    params : dict of {name: (min, max)} giving the parameters to vary and their ranges
+
+    base_params, optional : dict of the values of all other parameters (default: {})
+
+    outputs, optional : names of the outputs to emulate, e.g. ['scalar','lensed']
+                        (default: all of the Cl outputs CAMB returns at base_params). transfer
+                        outputs can only be emulated if their k's don't depend on the parameters
+
+    ncomponents, optional : number of PCA components kept for each output (default: 20)
+
+    order, optional : order of the polynomial fit in the parameters (default: 2)
+
+    tolerance, optional : estimated relative RMS error of an output above which CAMB is
+                          called instead (default: 1e-3)
+
+    Example ::
+
+        emu = emulator(camb, {'ombh2':(.021,.023), 'omch2':(.11,.13)}, {'get_scalar_cls':True})
+        emu.train(workers=8)
+        result = emu(ombh2=.0222, omch2=.12)
+        result['error']   #estimated relative error of each output
+
+    """
+
+    def __init__(self, camb, params, base_params=None, outputs=None, ncomponents=20, order=2, tolerance=1e-3):
+        self.camb = camb
+        self.names = list(params)
+        self.ranges = array([params[k] for k in self.names], dtype=float)
+        self.base_params = dict(base_params or {})
+        self.outputs = outputs
+        self.ncomponents = ncomponents
+        self.order = order
+        self.tolerance = tolerance
+        self.models = None
+        self.ncalls = self.nfallbacks = 0
+        self._base = None
+
+    def train(self, n=None, workers=None, seed=0):
+        """
+
+        Run CAMB at n points (default: 4 per polynomial term plus 10) filling the parameter
+        ranges with a Latin hypercube, concurrently with up to workers CAMB processes,
+        and fit the emulator to the results.
+
+        """
+        nterms = len(self._terms())
+        if n is None: n = 4*nterms + 10
+        if n <= nterms: raise ValueError("Need more than %i training points for order %i in %i parameters"%(nterms,self.order,len(self.names)))
+
+        design = latin_hypercube(dict(zip(self.names,self.ranges)), n, seed)
+        results = self.camb.map([dict(self.base_params, **p) for p in design], workers)
+        self.fit(array([[p[k] for k in self.names] for p in design]), results)
+        return self
+
+    def fit(self, x, results):
+        """Fit the emulator to the given results of CAMB runs at the (n_points, n_params) array of points x."""
+        if self.outputs is None: 
+            self.outputs = [k for k,v in results[0].items() if getattr(v,'ndim',0)==2 and k.split('(')[0] in _cl_outputs]
+        self._base = self._base_strings()
+        phi = self._features(asarray(x))
+        #leverage of each training point, used for the leave-one-out residuals
+        hat = (phi.dot(pinv(phi.T.dot(phi)))*phi).sum(axis=1)
+
+        self.models = {}
+        for k in self.outputs:
+            if any(r[k].shape!=results[0][k].shape or not allclose(r[k][:,0],results[0][k][:,0]) for r in results):
+                raise ValueError("The rows (e.g. k's) of output '%s' change with the parameters, so it can't be emulated."%k)
+            data = array([r[k] for r in results])
+            y = data[:,:,1:].reshape(len(data),-1)
+            m, s = y.mean(axis=0), y.std(axis=0)
+            s = where(s>0, s, 1)
+            u, sv, vt = svd((y-m)/s, full_matrices=False)
+            nc = min(self.ncomponents, len(sv))
+            z, vt = u[:,:nc]*sv[:nc], vt[:nc]
+            w = lstsq(phi, z, rcond=None)[0]
+
+            ynorm = norm(y, axis=1)
+            loo = (z - phi.dot(w))/(1-hat)[:,None]
+            truncation = (y-m)/s - z.dot(vt)
+            self.models[k] = {'x':data[0,:,0], 'mean':m, 'std':s, 'components':vt, 'weights':w,
+                              'loo_error':sqrt(mean((norm(loo.dot(vt)*s,axis=1)/ynorm)**2)),
+                              'truncation_error':sqrt(mean((norm(truncation*s,axis=1)/ynorm)**2))}
+        self._fisher_inv = pinv(phi.T.dot(phi))
+
+    def predict(self, **params):
+        """
+
+        Get the emulated outputs at the given values of the varied parameters,
+        regardless of whether they are in range or accurate enough.
+
+        Returns
+        -------
+        dict of outputs as CAMB would return them, plus 'error', a dict of the estimated
+        relative RMS error of each output
+
+        """
+        if self.models is None: raise Exception("The emulator hasn't been trained yet.")
+        phi = self._features(array([[float(params[k]) for k in self.names]]))
+        leverage = phi.dot(self._fisher_inv).dot(phi.T)[0,0]
+        result = {'error':{}}
+        for k,m in self.models.items():
+            y = m['mean'] + m['std']*phi.dot(m['weights']).dot(m['components'])[0]
+            out = ones((len(m['x']), len(y)//len(m['x'])+1))
+            out[:,0], out[:,1:] = m['x'], y.reshape(len(m['x']),-1)
+            result[k] = out
+            result['error'][k] = float(sqrt(m['loo_error']**2*(1+leverage) + m['truncation_error']**2))
+        return result
+
+    def __call__(self, **params):
+        """
+
+        Get the outputs for the given parameters, from the emulator if possible and otherwise
+        from CAMB. The result has an extra entry 'emulated' saying which was used.
+
+        """
+        self.ncalls += 1
+        query = dict(self.base_params, **params)
+        if self._in_range(query, params):
+            result = self.predict(**query)
+            if max(result['error'].values()) <= self.tolerance:
+                result['emulated'] = True
+                return result
+        self.nfallbacks += 1
+        result = self.camb(**query)
+        result['emulated'] = False
+        return result
+
+    def _in_range(self, query, params):
+        """
+        Check a query (base_params updated with params) only changes the varied parameters, 
+        and keeps them in their trained ranges.
+        """
+        if any(k not in query for k in self.names): return False
+        for (lo, hi), k in zip(self.ranges, self.names):
+            try:
+                if not lo <= float(query[k]) <= hi: return False
+            except ValueError: return False
+        if self._base is None: self._base = self._base_strings()
+        for k,v in params.items():
+            if k not in self.names and str(try_bool2str(v)) != self._base.get(k): return False
+        return True
+
+    def _base_strings(self):
+        """base_params with the defaults applied, as strings, which queries are compared to."""
+        return {k:str(try_bool2str(v)) for k,v in self.camb._apply_defaults(self.base_params).items()}
+
+    def _terms(self):
+        """All the monomials up to the given order, as tuples of parameter indices."""
+        return [t for o in range(self.order+1) for t in combinations_with_replacement(range(len(self.names)),o)]
+
+    def _features(self, x):
+        x = 2*(x - self.ranges[:,0])/(self.ranges[:,1]-self.ranges[:,0]) - 1
+        return array([prod(x[:,list(t)],axis=1) for t in self._terms()]).T
+
+    def save(self, filename):
+        """Save the trained emulator to a .npz file."""
+        meta = {'names':self.names, 'ranges':self.ranges.tolist(), 'base_params':self.base_params,
+                'outputs':self.outputs, 'ncomponents':self.ncomponents, 'order':self.order, 'tolerance':self.tolerance}
+        arrays = {'%s/%s'%(k,a):v for k,m in self.models.items() for a,v in m.items()}
+        savez_compressed(filename, meta=json.dumps(meta, default=try_bool2str), fisher_inv=self._fisher_inv, **arrays)
+
+    @classmethod
+    def load(cls, filename, camb):
+        """Load an emulator saved with save(). camb is used for any fallback calls."""
+        with npload(filename) as f:
+            meta = json.loads(str(f['meta']))
+            emu = cls(camb, dict(zip(meta['names'],meta['ranges'])), meta['base_params'], meta['outputs'],
+                      meta['ncomponents'], meta['order'], meta['tolerance'])
+            emu._fisher_inv = f['fisher_inv']
+            emu._base = emu._base_strings()
+            emu.models = {k:{} for k in emu.outputs}
+            for name in f.files:
+                if '/' in name:
+                    k,a = name.split('/')
+                    emu.models[k][a] = f[name][()] if f[name].ndim==0 else f[name]
+        return emu
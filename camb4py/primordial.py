@@ -0,0 +1,196 @@
+"""
+
+Fast paths for models which differ only in the primordial power spectrum, used by
+camb objects loaded with fast_primordial=True.
+
+Everything CAMB computes before the primordial spectrum is applied (the transfer
+functions) is the same for such models, so most of the run can be shared:
+
+* a model which differs from an earlier one only in scalar_amp(1) is not run at all.
+  Outputs which are linear in the amplitude (unlensed scalar, tensor, and lensing
+  potential Cl's, and the linear matter power) are rescaled from the earlier result,
+  and the transfer functions are copied. Models with lensed or vector Cl's, non-linear
+  corrections, or COBE normalization aren't linear in the amplitude and are always run.
+
+* in camb.map, models which differ only in scalar_amp(1), scalar_spectral_index(1),
+  and scalar_nrun(1) are packed, up to max_power_num at a time, into one CAMB run with
+  initial_power_num > 1, and the outputs are split back into one result per model.
+  CAMB writes the Cl's of each spectrum one after the other and the matter power of
+  each in its own column, and prints sigma8 for each spectrum in turn. Models already
+  in the cache, or which can be rescaled as above, are left out of the packing.
+
+"""
+
+import re, time
+from numpy import ndarray
+from .camb4py import _timings, _timer, _transfer_key, try_bool2str, try_str2bool
+
+#CAMB's limit on initial_power_num (nnmax in power_tilt.f90)
+max_power_num = 5
+
+#outputs which are proportional to scalar_amp(1), all others besides transfer can't be rescaled
+_linear_in_amplitude = ['scalar', 'tensor', 'lens_potential', 'transfer_matterpower']
+_not_linear_in_amplitude = ['lensed_output_file', 'vector_output_file']
+
+#parameters which may differ between models packed into one run, and those which are the same but
+#still need to be given for each spectrum
+_packed_params = ['scalar_amp', 'scalar_spectral_index', 'scalar_nrun']
+_per_spectrum_params = ['tensor_spectral_index', 'initial_ratio']
+_cl_outputs = ['scalar', 'vector', 'tensor', 'lensed', 'lens_potential']
+
+
+def rescaled(camb, params):
+    """Get the result for params by rescaling an earlier one differing only in scalar_amp(1), or None if there isn't one."""
+    if not _rescalable(camb, params): return None
+    with _timer('cache'):
+        result = _references(camb).get(_reference_key(camb, params))
+    if result is None: return None
+    ratio = float(params['scalar_amp(1)'])/result.pop('camb4py_scalar_amp')
+    for k,v in result.items():
+        if isinstance(v,ndarray) and _base_name(k) in _linear_in_amplitude: v[...,1:] *= ratio
+    result['misc'] = {k:(_rescale_sigma8(v, ratio) if k.startswith('sigma8') else v) for k,v in result['misc'].items()}
+    return result
+
+
+def add_reference(camb, params, result):
+    """Keep a result so later models differing only in scalar_amp(1) can be rescaled from it."""
+    if _rescalable(camb, params) and not _failed(camb, params, result):
+        _references(camb).put(_reference_key(camb, params), dict(result, camb4py_scalar_amp=float(params['scalar_amp(1)'])))
+
+
+def map_packed(camb, params_list, workers=None):
+    """camb.map, running models which differ only in their primordial power spectra together."""
+    from concurrent.futures import ThreadPoolExecutor
+    import os
+    params_list = list(params_list)
+    groups = {}
+    for i,params in enumerate(params_list):
+        p = camb._apply_defaults(params)
+        groups.setdefault(_packing_key(p) if _packable(p) and not _known(camb, p) else i, []).append((i,p))
+    tasks = [members[j:j+max_power_num] for members in groups.values() for j in range(0,len(members),max_power_num)]
+
+    results = [None]*len(params_list)
+    with ThreadPoolExecutor(workers or camb.workers or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(_run_single, camb, params_list[t[0][0]]) if len(t)==1 else pool.submit(_run_packed, camb, t)
+                   for t in tasks]
+        for t,f in zip(tasks,futures):
+            for (i,_),r in zip(t, f.result()): results[i] = r
+    return results
+
+
+def _run_single(camb, params):
+    return [camb(**params)]
+
+
+def _run_packed(camb, members):
+    """Run several models with initial_power_num=len(members), returning a result for each."""
+    timings, start = {}, time.perf_counter()
+    token = _timings.set(timings)
+    try:
+        t0 = time.time()
+        result = camb._run_with_deadline(_pack([p for _,p in members]))
+        runtime = (time.time() - t0)/len(members)
+    finally:
+        _timings.reset(token)
+    timings['total'] = time.perf_counter() - start
+
+    results = []
+    for j,(_,p) in enumerate(members):
+        r = _split(result, j, len(members))
+        if not _failed(camb, p, r):
+            if camb.cache is not None: camb.cache.put(camb.cache.key(camb.executable, p), r, runtime, camb._result_names(p))
+            add_reference(camb, p, r)
+        camb._record_timings(r, dict(timings), p)
+        results.append(camb._make_result(r, p))
+    return results
+
+
+def _pack(members):
+    """Parameters of one run with a primordial spectrum for each of members."""
+    p = dict(members[0])
+    p['initial_power_num'] = len(members)
+    for j,m in enumerate(members):
+        for k in _packed_params+_per_spectrum_params:
+            if '%s(1)'%k in m: p['%s(%i)'%(k,j+1)] = m['%s(1)'%k]
+    return p
+
+
+def _split(result, j, n):
+    """Get the outputs for the j-th of n primordial spectra from the result of a packed run."""
+    out = {}
+    for k,v in result.items():
+        name = _base_name(k)
+        if k=='misc': out[k] = _split_misc(v, result.get('stdout',b''), j, n)
+        elif isinstance(v,dict): out[k] = dict(v)
+        elif not isinstance(v,ndarray): out[k] = v
+        elif name in _cl_outputs:
+            if len(v)%n: raise Exception("Can't split the %s output of %i rows into %i spectra"%(k,len(v),n))
+            out[k] = v.reshape((n,-1)+v.shape[1:])[j]
+        elif name=='transfer_matterpower': out[k] = v[:,[0,1+j]]
+        else: out[k] = v.copy()
+    return out
+
+
+def _split_misc(misc, stdout, j, n):
+    """
+    Get the quantities printed for the j-th of n primordial spectra. sigma8 is printed for each 
+    spectrum (and redshift) in turn, and like in _parse_stdout the last value printed for the 
+    spectrum is kept. It's left out if it can't be matched up with the spectra.
+    """
+    out = dict(misc)
+    for k in [k for k in misc if k.startswith('sigma8')]:
+        values = re.findall(re.escape(k)+r'\s*=\s*(\S+)', stdout.decode(errors='replace'))
+        if values and len(values)%n==0: out[k] = values[(j+1)*len(values)//n-1]
+        else: out.pop(k)
+    return out
+
+
+def _known(camb, p):
+    """Whether a model is in the cache or can be rescaled from an earlier one, so needn't be run."""
+    if camb.cache is not None and camb.cache.key(camb.executable, p) in camb.cache: return True
+    return _rescalable(camb, p) and _reference_key(camb, p) in _references(camb)
+
+
+def _packable(p):
+    return str(p.get('initial_power_num','1')).strip()=='1' and str(p.get('do_nonlinear','0')).strip()=='0'
+
+
+def _packing_key(p):
+    return tuple(sorted((k,str(try_bool2str(try_str2bool(v))).strip()) for k,v in p.items()
+                        if k.split('(')[0] not in _packed_params or k[-3:]!='(1)'))
+
+
+def _rescalable(camb, p):
+    try: float(p['scalar_amp(1)'])
+    except (KeyError, ValueError): return False
+    return (_packable(p) and try_str2bool(p.get('COBE_normalize')) is not True
+            and not any(k in _not_linear_in_amplitude for k in camb._get_output_keys(p)))
+
+
+def _failed(camb, p, result):
+    """Whether result has errors in place of outputs or is missing any, so mustn't be reused."""
+    return (any(isinstance(v,Exception) for v in result.values())
+            or any(k not in result for k in camb._result_names(p)))
+
+
+def _references(camb):
+    if getattr(camb,'_primordial_references',None) is None:
+        from .cache import result_cache
+        camb._primordial_references = result_cache(max_bytes=2**28)
+    return camb._primordial_references
+
+
+def _reference_key(camb, p):
+    #after a run, p also holds the names of the output files, which aren't part of the model
+    return _references(camb).key(camb.executable, {k:v for k,v in p.items() if k!='scalar_amp(1)' 
+                                                   and k not in camb.output_names and not _transfer_key.match(k)})
+
+
+def _base_name(key):
+    return key.split('(')[0]
+
+
+def _rescale_sigma8(value, ratio):
+    """sigma8 goes as the square root of the amplitude."""
+    try: return '%.6g'%(float(value)*ratio**.5)
+    except ValueError: return value
@@ -0,0 +1,114 @@
+from numpy import ndarray
+from .camb4py import try_str2bool
+
+
+class columns(object):
+    """
+
+    A CAMB output, with each column of the underlying array available by name, e.g.
+    result.scalar.TT or result.transfer_matterpower.k. Columns are views into
+    the array, not copies. The array itself is in .data, and columns without a
+    known name can be had by index, e.g. result.scalar[:,7].
+
+    """
+
+    __slots__ = ('data','names')
+
+    def __init__(self, data, names):
+        self.data = data
+        self.names = names[:data.shape[-1]]
+
+    def __getattr__(self, name):
+        if name in columns.__slots__: raise AttributeError(name)
+        try: return self.data[...,self.names.index(name)]
+        except ValueError: raise AttributeError("No column '%s' in this output, which has columns %s"%(name,self.names))
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.data if dtype is None else self.data.astype(dtype)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __dir__(self):
+        return list(self.names) + ['data','names','shape']
+
+    def __repr__(self):
+        return 'columns(%s, shape=%s)'%(', '.join(self.names), self.data.shape)
+
+
+
+class camb_result(object):
+    """
+
+    The result of a call to CAMB, returned instead of a dict by camb objects loaded
+    with result_type='object'.
+
+    Each output is an attribute (e.g. result.scalar, result.lensed) whose columns
+    can be accessed by name, e.g. result.lensed.BB. Indexing like a dict, e.g.
+    result['scalar'], gives the plain arrays as before, and to_dict() converts back
+    to the dict the default result_type would have returned, without copying anything.
+
+    """
+
+    __slots__ = ('scalar','vector','tensor','lensed','lens_potential','transfer','transfer_matterpower',
+                 'stdout','misc','timings','extra')
+
+    def __init__(self, result, params):
+        self.extra = {}
+        lensing = try_str2bool(params.get('do_lensing',False)) is True
+        for k,v in result.items():
+            if isinstance(v,ndarray) and k in _column_names:
+                names = _column_names[k]
+                if k=='scalar' and not lensing: names = names[:4]
+                v = columns(v, names)
+            self[k] = v
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__ and key!='extra': setattr(self, key, value)
+        else: self.extra[key] = value
+
+    def __getitem__(self, key):
+        try: value = getattr(self, key) if key in self.__slots__ and key!='extra' else self.extra[key]
+        except AttributeError: raise KeyError(key)
+        return value.data if isinstance(value,columns) else value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [k for k in self.__slots__ if k!='extra' and hasattr(self,k)] + list(self.extra)
+
+    def items(self):
+        return [(k,self[k]) for k in self.keys()]
+
+    def get(self, key, default=None):
+        try: return self[key]
+        except KeyError: return default
+
+    def to_dict(self):
+        """Get the result as a plain dict of arrays."""
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'camb_result(%s)'%', '.join(self.keys())
+
+
+
+_column_names = {'scalar':['L','TT','EE','TE','PP','TP','EP'],
+                 'vector':['L','TT','EE','BB','TE'],
+                 'tensor':['L','TT','EE','BB','TE'],
+                 'lensed':['L','TT','EE','BB','TE'],
+                 'lens_potential':['L','TT','EE','BB','TE','PP','TP','EP'],
+                 'transfer':['k','CDM','baryon','photon','massless_nu','massive_nu','total',
+                             'no_nu','total_de','Weyl','v_CDM','v_b','v_b_minus_v_c'],
+                 'transfer_matterpower':['k','P']}
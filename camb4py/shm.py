@@ -0,0 +1,245 @@
+"""
+
+Results in shared memory, for passing between processes without copying.
+
+A camb object loaded with result_type='shared' returns shared_result objects, whose
+arrays (and CAMB's stdout) live in a multiprocessing.shared_memory block. Pickling one,
+e.g. to send it through a multiprocessing.Queue, only sends the name of the block and
+where each array is in it, and unpickling it in another process maps the same memory,
+so the arrays are never copied ::
+
+    #in each worker process
+    camb = camb4py.load(result_type='shared')
+    queue.put(camb(**params))
+
+    #in the coordinator
+    result = queue.get()
+    cls = result['scalar']       #a view into the shared memory
+    ...
+    result.release()             #done with it, free the memory
+
+Each block is freed once release() has been called on the result in any process, and
+every process which mapped it has closed it (which release() and close() do). A result
+which is garbage collected is released too, unless it was pickled since it was made or
+unpickled, in which case the copy it was sent to is responsible for it.
+
+Results which are pickled but never unpickled, e.g. because the coordinator stopped
+reading a queue, would otherwise stay in shared memory. Worker processes started by
+multiprocessing exit without running atexit handlers, so they can't clean up after
+themselves. Instead, the names of all blocks start with prefix, which is picked by init
+(called by load(result_type='shared'), or on the first shared result) and inherited by
+processes started afterwards. When the process which picked it exits, it frees every block
+with its prefix, i.e. those made by any of its workers, so call init in the coordinator
+before starting workers if it doesn't load a camb object with result_type='shared' itself.
+To free them during a long run, call e.g. release_all(prefix, older_than=600) in the
+coordinator. Finding the blocks of other processes needs /dev/shm, so this only works on Linux.
+
+"""
+
+import os, time, atexit
+from collections.abc import Mapping
+from threading import Lock
+from weakref import WeakValueDictionary
+
+#arrays start on cache line boundaries
+_align = 64
+
+#the start of the name of every block, shared by this process and those it starts, set by init
+prefix = None
+_init_lock = Lock()
+_shm_dir = '/dev/shm'
+
+#names of the blocks created by this process which haven't been released, and the results mapped in this process
+_created = set()
+_live = WeakValueDictionary()
+_prune_every = 1000
+
+
+class shared_result(Mapping):
+    """
+
+    The result of a call to CAMB held in shared memory, returned instead of a dict by camb
+    objects loaded with result_type='shared'. It can be used like the dict, e.g. result['scalar'],
+    and to_dict() gives the dict itself, with the arrays as views into the shared memory.
+
+    """
+
+    __slots__ = ('name','layout','other','_shm','_owner','__weakref__')
+
+    def __init__(self, name, layout, other, shm=None):
+        self.name, self.layout, self.other = name, layout, other
+        self._shm = shm if shm is not None else _attach(name)
+        #the latest copy of the result to be made or unpickled frees the memory when it's garbage collected
+        self._owner = True
+        _live[name] = self
+
+    @classmethod
+    def from_result(cls, result):
+        """Copy the arrays and stdout of a result dict into a new block of shared memory."""
+        from numpy import ndarray, frombuffer, uint8
+        arrays = {k:v for k,v in result.items() if isinstance(v,ndarray)}
+        if isinstance(result.get('stdout'),bytes): arrays['stdout'] = frombuffer(result['stdout'],dtype=uint8)
+        layout, offset = {}, 0
+        for k,v in arrays.items():
+            layout[k] = (offset, v.shape, v.dtype.str)
+            offset += -(-v.nbytes//_align)*_align
+        shm = _create(max(offset,1))
+        for k,v in arrays.items():
+            o, shape, dtype = layout[k]
+            ndarray(shape, dtype, shm.buf, o)[...] = v
+        return cls(shm.name, layout, {k:v for k,v in result.items() if k not in arrays}, shm)
+
+    def __getitem__(self, key):
+        if key in self.layout:
+            if self._shm is None: raise ValueError("This shared result has been released or closed.")
+            from numpy import ndarray
+            o, shape, dtype = self.layout[key]
+            a = ndarray(shape, dtype, self._shm.buf, o)
+            return a.tobytes() if key=='stdout' else a
+        return self.other[key]
+
+    def __setitem__(self, key, value):
+        self.layout.pop(key, None)
+        self.other[key] = value
+
+    def __iter__(self):
+        return iter(list(self.layout)+[k for k in self.other if k not in self.layout])
+
+    def __len__(self):
+        return len(self.layout)+len(self.other)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    @property
+    def nbytes(self):
+        """Size of the shared memory block."""
+        return self._shm.size if self._shm is not None else 0
+
+    def __reduce__(self):
+        self._owner = False
+        return (shared_result, (self.name, self.layout, self.other))
+
+    def release(self):
+        """
+        Free the shared memory, once every other process using it has closed it. Arrays from
+        this result mustn't be used afterwards.
+        """
+        if self._shm is not None: _unlink(self._shm)
+        _created.discard(self.name)
+        self.close()
+
+    def close(self):
+        """
+        Stop using the shared memory in this process without freeing it, e.g. in a worker after
+        sending the result to another process.
+        """
+        shm, self._shm, self._owner = self._shm, None, False
+        if shm is None: return
+        if _live.get(self.name) is self: del _live[self.name]
+        _close(shm)
+
+    def __del__(self):
+        try:
+            if self._owner: self.release()
+            else: self.close()
+        except Exception: pass
+
+    def __repr__(self):
+        return 'shared_result(%r, %s)'%(self.name, ', '.join(self))
+
+
+def release_all(prefix=None, older_than=None):
+    """
+
+    Free all of the shared memory created by this process, or mapped in it and not yet released.
+
+    Parameters
+    ----------
+
+    prefix, optional : also free every block whose name starts with this, from any process,
+                       e.g. camb4py.shm.prefix for all those made by this process and its workers
+
+    older_than, optional : only free blocks which were made more than this many seconds ago,
+                           so results still on their way aren't lost
+
+    """
+    cutoff = None if older_than is None else time.time() - older_than
+    for result in list(_live.values()): 
+        if _made_before(result.name, cutoff): result.release()
+    names = set(_created)
+    if prefix is not None and os.path.isdir(_shm_dir): 
+        names.update(n for n in os.listdir(_shm_dir) if n.startswith(prefix))
+    for name in names:
+        if not _made_before(name, cutoff): continue
+        _created.discard(name)
+        try: shm = _attach(name)
+        except OSError: continue
+        _unlink(shm)
+        _close(shm)
+
+def init():
+    """
+    Pick the prefix of the blocks made by this process and those it starts afterwards (unless
+    it inherited one), and free them all when this process exits. Returns the prefix.
+    """
+    global prefix
+    with _init_lock:
+        if prefix is None:
+            if 'CAMB4PY_SHM_PREFIX' not in os.environ: os.environ['CAMB4PY_SHM_PREFIX'] = 'camb4py_%i_'%os.getpid()
+            prefix = os.environ['CAMB4PY_SHM_PREFIX']
+            atexit.register(_release_at_exit)
+    return prefix
+
+def _release_at_exit():
+    #the process which picked the prefix cleans up after all of its workers too
+    release_all(prefix if prefix=='camb4py_%i_'%os.getpid() else None)
+
+
+def _create(size):
+    from multiprocessing import shared_memory
+    from uuid import uuid4
+    shm = shared_memory.SharedMemory(name=(prefix or init())+uuid4().hex[:12], create=True, size=size)
+    _untrack(shm)
+    _created.add(shm.name)
+    if len(_created)%_prune_every==0: _prune()
+    return shm
+
+def _attach(name):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    _untrack(shm)
+    return shm
+
+def _untrack(shm):
+    """
+    Blocks are freed by release and release_all rather than by the resource tracker, which would
+    free them when the process which created them (or in Python<3.13, mapped them) exits.
+    """
+    from multiprocessing import shared_memory, resource_tracker
+    if getattr(shared_memory,'_USE_POSIX',False):
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+def _unlink(shm):
+    #SharedMemory.unlink would also unregister it from the resource tracker, which _untrack already did
+    from multiprocessing import shared_memory
+    try:
+        if getattr(shared_memory,'_USE_POSIX',False): shared_memory._posixshmem.shm_unlink(shm._name)
+        else: shm.unlink()
+    except FileNotFoundError: pass
+
+def _close(shm):
+    #arrays from the block hold on to its mmap and don't stop it being closed, so rather than closing
+    #it, drop it, and it's unmapped when the last of them is gone
+    shm._buf = shm._mmap = None
+    shm.close()
+
+def _made_before(name, cutoff):
+    if cutoff is None: return True
+    try: return os.stat(os.path.join(_shm_dir,name)).st_mtime < cutoff
+    except OSError: return False
+
+def _prune():
+    """Forget blocks which were released by another process, so _created doesn't grow forever."""
+    if os.path.isdir(_shm_dir):
+        for name in [n for n in _created if not os.path.exists(os.path.join(_shm_dir,n))]: _created.discard(name)
@@ -0,0 +1,21 @@
+    !Driver for camb4py's 'server' protocol. 
+    !
+    !Each line read from stdin is the path to an ini file, which is run exactly like
+    !the regular inidriver would run it (setup.py turns CAMB's inidriver program into
+    !the camb4py_driver subroutine). A sentinel line is printed after each run so 
+    !camb4py knows the outputs are ready. The loop ends when stdin is closed.
+
+    program camb4py_server
+    implicit none
+    character(LEN=1024) :: InputFile
+    integer :: status
+
+    do
+        read(*,'(A)',iostat=status) InputFile
+        if (status /= 0) exit
+        call camb4py_driver(trim(InputFile))
+        write(*,'(A)') 'CAMB4PY_DONE'
+        flush(6)
+    end do
+
+    end program camb4py_server
@@ -0,0 +1,203 @@
+import os, json, time
+from numpy import array, nan
+from numpy.lib.format import open_memmap
+from numpy.random import RandomState
+
+
+def grid(**axes):
+    """
+
+    A design with every combination of the given values of each parameter, e.g. ::
+
+        grid(ombh2=linspace(.021,.023,10), omch2=linspace(.11,.13,10))   #100 models
+
+    """
+    design = [{}]
+    for k,values in axes.items():
+        design = [dict(d,**{k:_item(v)}) for d in design for v in values]
+    return design
+
+
+def latin_hypercube(ranges, n, seed=0):
+    """
+
+    A design of n models filling the given {name: (min, max)} ranges, with one model
+    in each of the n equal slices of the range of every parameter.
+
+    """
+    names = list(ranges)
+    lo, hi = array([ranges[k] for k in names], dtype=float).T
+    rand = RandomState(seed)
+    x = (array([rand.permutation(n) for _ in names]).T + rand.uniform(size=(n,len(names))))/n
+    return [dict(zip(names,(lo + xi*(hi-lo)).tolist())) for xi in x]
+
+
+
+class sweep(object):
+    """
+
+    A set of models whose results are stored in a directory as they're computed,
+    so that an interrupted run can be resumed, and results can be read before
+    the whole sweep is done.
+
+    Each output is stored in a .npy file of shape (n_models, n_rows, n_cols) which
+    is memory-mapped rather than read into memory, with rows of models which haven't
+    been computed filled with NaN. done.npy says which models are finished, and the
+    quantities CAMB printed for each model are in misc.jsonl.
+
+    Parameters
+    ----------
+
+    directory : where to store the sweep.
+
+    design, optional : list of dicts of parameters, one per model (see grid and latin_hypercube).
+                       if the directory already has a sweep, this must be the same design,
+                       or None to just open it.
+
+    base_params, optional : parameters common to all models (default: {})
+
+    Example ::
+
+        s = sweep('/path/to/sweep', latin_hypercube({'ombh2':(.021,.023)}, 10000), {'get_scalar_cls':True})
+        s.run(camb, workers=8)    #can be interrupted and called again to continue
+        s['scalar'][s.done]       #everything finished so far
+
+    """
+
+    def __init__(self, directory, design=None, base_params=None):
+        self.directory = directory
+        info_file = os.path.join(directory,'design.json')
+        if os.path.exists(info_file):
+            with open(info_file) as f: info = json.load(f)
+            if design is not None and (_canonical(design), _canonical(base_params or {})) != (_canonical(info['design']), _canonical(info['base_params'])):
+                raise ValueError("'%s' already holds a sweep with a different design or base_params."%directory)
+        elif design is None:
+            raise ValueError("'%s' doesn't hold a sweep, so a design is needed."%directory)
+        else:
+            if not os.path.exists(directory): os.makedirs(directory)
+            info = {'design':[{k:_item(v) for k,v in p.items()} for p in design], 'base_params':base_params or {}}
+            with open(info_file+'.tmp','w') as f: json.dump(info, f, default=str)
+            os.replace(info_file+'.tmp', info_file)
+        self.design, self.base_params = info['design'], info['base_params']
+
+        done_file = os.path.join(directory,'done.npy')
+        if not os.path.exists(done_file): open_memmap(done_file, mode='w+', dtype=bool, shape=(len(self.design),)).flush()
+        self._done = open_memmap(done_file, mode='r+')
+        self._outputs = {}
+
+    def __len__(self):
+        return len(self.design)
+
+    @property
+    def done(self):
+        """Boolean array saying which models are finished."""
+        return array(self._done)
+
+    def keys(self):
+        """The names of the stored outputs."""
+        return sorted(f[:-4] for f in os.listdir(self.directory) if f.endswith('.npy') and not f.endswith('.tmp.npy') and f!='done.npy')
+
+    def __getitem__(self, key):
+        """Get a read-only memory-map of one output, of shape (n_models, n_rows, n_cols)."""
+        if key not in self.keys(): raise KeyError(key)
+        return open_memmap(os.path.join(self.directory,'%s.npy'%key), mode='r')
+
+    def misc(self):
+        """Get the quantities CAMB printed (e.g. the age of the universe) for each finished model, as a dict of {index: misc}."""
+        misc = {}
+        try:
+            with open(os.path.join(self.directory,'misc.jsonl')) as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue   #a line cut off by a crash
+                    misc[entry['index']] = entry['misc']
+        except IOError:
+            pass
+        return misc
+
+    def run(self, camb, workers=None, checkpoint=10):
+        """
+
+        Compute all of the models which aren't done yet.
+
+        Parameters
+        ----------
+
+        camb : the camb object to use (e.g. from camb4py.load)
+
+        workers, optional : number of models to run at once (see camb.map)
+
+        checkpoint, optional : how often (in seconds) finished models are flushed to disk and
+                               marked as done. models finished since the last checkpoint are
+                               recomputed if the run is interrupted (default: 10)
+
+        Returns
+        -------
+        the number of models which failed and are left to do
+
+        """
+        todo = [i for i in range(len(self)) if not self._done[i]]
+        finished, failed, last = [], 0, time.time()
+        with open(os.path.join(self.directory,'misc.jsonl'),'a') as misc:
+            try:
+                params = (dict(self.base_params, **self.design[i]) for i in todo)
+                for j, result in camb.imap(params, workers):
+                    i = todo[j]
+                    if not self._store(i, result):
+                        failed += 1
+                        continue
+                    misc.write(json.dumps({'index':i, 'misc':result.get('misc')}, default=str)+'\n')
+                    finished.append(i)
+                    if time.time() - last > checkpoint:
+                        self._checkpoint(finished, misc)
+                        finished, last = [], time.time()
+            finally:
+                self._checkpoint(finished, misc)
+        return failed
+
+    def _store(self, i, result):
+        """Write one model's outputs into the arrays, returning False if it failed."""
+        arrays = {k:v for k,v in result.items() if hasattr(v,'shape')}
+        errors = [k for k,v in result.items() if isinstance(v,Exception)]
+        if errors or not arrays:
+            print('Warning: model %i failed (%s)'%(i, ', '.join(errors) or 'no outputs'))
+            return False
+        for k,v in arrays.items():
+            out = self._output(k, v.shape)
+            fit = tuple(slice(0,min(a,b)) for a,b in zip(v.shape,out.shape[1:]))
+            if v[fit].shape!=v.shape: print("Warning: model %i's %s output of shape %s was cut to fit %s"%(i,k,v.shape,out.shape[1:]))
+            out[(i,)+fit] = v[fit]
+        return True
+
+    def _output(self, key, shape):
+        """Get the memory-mapped array for an output, creating it given the shape of the first result."""
+        if key not in self._outputs:
+            filename = os.path.join(self.directory,'%s.npy'%key)
+            if not os.path.exists(filename):
+                out = open_memmap(filename+'.tmp.npy', mode='w+', shape=(len(self),)+shape)
+                out[:] = nan
+                out.flush()
+                del out
+                os.replace(filename+'.tmp.npy', filename)
+            self._outputs[key] = open_memmap(filename, mode='r+')
+        return self._outputs[key]
+
+    def _checkpoint(self, finished, misc):
+        """Flush the outputs to disk, and only then mark the models finished since the last checkpoint as done."""
+        for out in self._outputs.values(): out.flush()
+        misc.flush()
+        self._done[finished] = True
+        self._done.flush()
+
+    def __repr__(self):
+        return 'sweep(%r, %i/%i done, outputs: %s)'%(self.directory, self._done.sum(), len(self), ', '.join(self.keys()))
+
+
+
+def _item(v):
+    """Turn numpy scalars into Python ones, so they can be stored as JSON."""
+    return v.item() if hasattr(v,'item') else v
+
+def _canonical(design):
+    return json.dumps(design if isinstance(design,dict) else [{k:_item(v) for k,v in p.items()} for p in design],
+                      sort_keys=True, default=str)
@@ -0,0 +1,112 @@
+"""
+
+Tuning how many CAMB processes to run at once and how many threads each should use.
+
+CAMB's number_of_threads and the number of concurrent CAMB processes (the workers of
+camb.map) compete for the same cores, and which split gives the most models per second
+depends on the models. tune() measures this for some representative models, and sets
+up the camb object to use the best split, with each process pinned to its own cores.
+The result is stored in ~/.camb4py/tune.json so later sessions on the same machine can
+reuse it without measuring again.
+
+"""
+
+import os, json, time, socket, hashlib
+
+_tune_file = os.path.join(os.path.expanduser('~'),'.camb4py','tune.json')
+
+
+def tune(camb, params_list=None, threads=None, n=None, force=False, filename=None):
+    """
+
+    Find the split of cores into CAMB processes and threads per process which runs
+    the given models fastest, and apply it to camb, setting camb.workers,
+    camb.cpu_sets, and number_of_threads in camb.defaults.
+
+    Parameters
+    ----------
+
+    camb : a camb object (from camb4py.load)
+
+    params_list, optional : list of dicts of parameters of representative models
+                            (default: scalar Cl's with and without lensing, and the matter power)
+
+    threads, optional : list of numbers of threads per process to try (default: 1, 2, 4, ...
+                        up to the number of cores, and the number of cores itself)
+
+    n, optional : number of models to run for each split (default: enough to keep every
+                  process busy at least twice, and at least len(params_list))
+
+    force, optional : measure again even if there's a stored result for this machine,
+                      executable, and params_list (default: False)
+
+    filename, optional : where results are stored (default: ~/.camb4py/tune.json)
+
+    Returns
+    -------
+    dict with the chosen 'threads' and 'workers', their 'models_per_sec', and the
+    measurements of every split tried ('trials')
+
+    """
+    filename = filename or _tune_file
+    if params_list is None:
+        params_list = [{'get_scalar_cls':True}, {'get_scalar_cls':True, 'do_lensing':True}, {'get_transfer':True}]
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    key = _key(camb, params_list, cpus)
+
+    stored = _read(filename).get(key)
+    if stored is not None and not force:
+        _apply(camb, stored['threads'], cpus)
+        return stored
+
+    if threads is None:
+        threads = sorted(set([2**i for i in range(len(cpus).bit_length()) if 2**i<=len(cpus)] + [len(cpus)]))
+
+    trials, cache = [], camb.cache
+    camb.cache = None
+    try:
+        for t in threads:
+            workers = _apply(camb, t, cpus)
+            nmodels = n or max(2*workers, len(params_list))
+            models = [params_list[i%len(params_list)] for i in range(nmodels)]
+            start = time.perf_counter()
+            camb.map(models, workers)
+            trials.append({'threads':t, 'workers':workers, 'models_per_sec':nmodels/(time.perf_counter()-start)})
+    finally:
+        camb.cache = cache
+
+    best = dict(max(trials, key=lambda trial: trial['models_per_sec']), trials=trials)
+    _apply(camb, best['threads'], cpus)
+    _write(filename, key, best)
+    return best
+
+
+def _apply(camb, threads, cpus):
+    """Set up camb to run len(cpus)//threads processes with threads threads each, each on its own CPUs."""
+    workers = max(1, len(cpus)//threads)
+    #a copy, since the defaults may be a dict shared with the caller or other camb objects
+    camb.defaults = dict(camb.defaults, number_of_threads=threads)
+    camb.workers = workers
+    camb.cpu_sets = [cpus[i*threads:(i+1)*threads] for i in range(workers)] if threads<=len(cpus) else None
+    return workers
+
+
+def _key(camb, params_list, cpus):
+    """Results are stored per machine, executable, CPUs available, and set of models."""
+    models = hashlib.sha1(json.dumps(params_list, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return '%s:%s:%i:%s'%(socket.gethostname(), camb.executable, len(cpus), models)
+
+
+def _read(filename):
+    try:
+        with open(filename) as f: return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write(filename, key, result):
+    stored = _read(filename)
+    stored[key] = result
+    if not os.path.exists(os.path.dirname(filename)): os.makedirs(os.path.dirname(filename))
+    with open(filename+'.tmp','w') as f: json.dump(stored, f, indent=2)
+    os.replace(filename+'.tmp', filename)
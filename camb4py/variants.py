@@ -0,0 +1,139 @@
+"""
+
+Choosing between the variants of the built-in CAMB compiled by setup.py build,
+
+    portable : optimized, but runs on any CPU of the architecture it was built on (camb)
+    native   : also tuned for the CPU of the build machine (camb_native)
+    pgo      : optimized using a profile of CAMB running some typical models (camb_pgo)
+
+camb4py.load(variant='fastest') runs the same model with each variant which was built,
+checks each gives the same outputs as the first one which works (so e.g. a native variant built
+on a newer CPU, which crashes, isn't picked), and uses the fastest. The comparison is
+stored in ~/.camb4py/variants.json, so it's only done once per machine and build.
+
+"""
+
+import os, json, socket
+from .camb4py import get_default_executable
+
+variants = ['portable', 'native', 'pgo']
+_variants_file = os.path.join(os.path.expanduser('~'),'.camb4py','variants.json')
+
+#the model timed by compare, similar to the ones used to train the pgo variant
+_compare_params = {'get_scalar_cls':True, 'do_lensing':True, 'get_transfer':True}
+
+
+def get_variant_executable(name, variant):
+    """Get the path of a variant of a built-in executable (name is 'camb' or 'camb_server')."""
+    if variant=='fastest': 
+        #the fastest variant which works, of those built for this executable
+        times = fastest()['times']
+        built = [v for v in available(name) if times.get(v) is not None]
+        if not built: raise Exception("None of the variants of the built-in %s work on this machine."%name)
+        variant = min(built, key=times.get)
+    if variant not in variants:
+        raise ValueError("Unknown CAMB variant '%s', expected one of %s"%(variant, variants+['fastest']))
+    executable = get_default_executable(_executable_name(name, variant))
+    if executable is None:
+        raise Exception("The %s variant of the built-in CAMB wasn't built. Re-install camb4py with it in setup.py build's --variants."%variant)
+    return executable
+
+
+def available(name='camb'):
+    """Get the variants of a built-in executable which were built."""
+    return [v for v in variants if get_default_executable(_executable_name(name, v)) is not None]
+
+
+def fastest(force=False, filename=None):
+    """
+
+    Find which variant of the built-in CAMB is fastest on this machine, measuring it with
+    compare unless it was measured before for the same build.
+
+    Returns
+    -------
+    dict with the chosen 'variant', and the 'times' of each variant as returned by compare
+
+    """
+    filename = filename or _variants_file
+    key = _key()
+    stored = _read(filename).get(key)
+    if stored is not None and not force: return stored
+
+    times = compare()
+    working = {v:t for v,t in times.items() if t is not None}
+    if not working: raise Exception("None of the variants of the built-in CAMB work on this machine.")
+    best = {'variant':min(working, key=working.get), 'times':times}
+    _write(filename, key, best)
+    return best
+
+
+def compare(params=None, repeats=3):
+    """
+
+    Time how long each variant of the built-in CAMB takes to run a model.
+
+    Parameters
+    ----------
+
+    params, optional : dict of parameters of the model
+                       (default: lensed scalar Cl's and the matter power)
+
+    repeats, optional : the fastest of this many runs is used for each variant (default: 3)
+
+    Returns
+    -------
+    dict of {variant: seconds}, with None for variants which fail or whose outputs differ
+    from those of the first variant which works
+
+    """
+    from numpy import allclose, ndarray
+    from .camb4py import camb_disk
+    params = dict(_compare_params if params is None else params)
+    times, reference = {}, None
+    for variant in available():
+        camb = camb_disk(get_variant_executable('camb', variant))
+        best = None
+        try:
+            for _ in range(repeats):
+                result = camb(**params)
+                outputs = {k:v for k,v in result.items() if isinstance(v,ndarray)}
+                if not outputs or any(isinstance(v,Exception) for v in result.values()): raise Exception('no outputs')
+                t = result['timings']['call_camb']
+                best = t if best is None else min(best, t)
+        except Exception as e:
+            print("Warning: the %s variant of CAMB doesn't work on this machine (%s)"%(variant,e))
+            times[variant] = None
+            continue
+        if reference is None:
+            reference = (variant, outputs)
+        elif set(outputs)!=set(reference[1]) or not all(allclose(outputs[k], reference[1][k], rtol=1e-3) for k in outputs):
+            print("Warning: the %s variant of CAMB gives different results from the %s variant"%(variant,reference[0]))
+            best = None
+        times[variant] = best
+    return times
+
+
+def _executable_name(name, variant):
+    return name if variant=='portable' else '%s_%s'%(name,variant)
+
+
+def _key():
+    """Results are stored per machine and build of the executables."""
+    executables = [get_default_executable(_executable_name('camb', v)) for v in available()]
+    return '%s:%s'%(socket.gethostname(), ','.join('%s@%i'%(e,os.stat(e).st_mtime) for e in executables))
+
+
+def _read(filename):
+    try:
+        with open(filename) as f: return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write(filename, key, result):
+    stored = _read(filename)
+    stored[key] = result
+    if not os.path.exists(os.path.dirname(filename)): os.makedirs(os.path.dirname(filename))
+    with open(filename+'.tmp','w') as f: json.dump(stored, f, indent=2)
+    os.replace(filename+'.tmp', filename)
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
-import os, urllib.request, urllib.error, urllib.parse, tarfile
+import os, re, json, urllib.request, urllib.error, urllib.parse, tarfile, subprocess
 from numpy.distutils.command.build import build as _build
 from numpy.distutils.core import setup
 import numpy.distutils.fcompiler as FC
-from distutils.errors import DistutilsError
+from distutils.errors import DistutilsError, CCompilerError
 
 
 class build(_build):
@@ -26,9 +26,24 @@ class build(_build):
             'camb',
             'inidriver']
     
+    #optimization flags of each variant of the built-in CAMB, for gnu and intel compilers.
+    #with other compilers only the portable variant is built, with the compiler's default flags.
+    variant_flags = {'gnu':  {'portable':['-O3','-flto'], 'native':['-O3','-flto','-march=native'], 'pgo':['-O3','-flto']},
+                     'intel':{'portable':['-O3','-ipo'],  'native':['-O3','-ipo','-xHost'],         'pgo':['-O3','-ipo']}}
+    
+    #flags to build an instrumented CAMB which records a profile in a directory, and to use that profile
+    pgo_flags = {'gnu':  (['-fprofile-generate=%s'], ['-fprofile-use=%s','-fprofile-correction']),
+                 'intel':(['-prof-gen','-prof-dir=%s'], ['-prof-use','-prof-dir=%s'])}
+    
+    #models run by the instrumented CAMB to train the pgo variant
+    pgo_training = [{'get_scalar_cls':'T', 'do_lensing':'T'},
+                    {'get_scalar_cls':'T', 'get_tensor_cls':'T', 'get_transfer':'T'},
+                    {'get_transfer':'T', 'do_nonlinear':'1', 'transfer_kmax':'10'}]
+    
     user_options = _build.user_options + [
         ('no-builtin', None,  "don't compile or install the built-in CAMB"),
         ('no-openmp', None,  "compile without OpenMP"),
+        ('variants=', None,  "comma-separated variants of the built-in CAMB to build, from portable, native, and pgo (default: all)"),
         ]
     
     boolean_options = _build.boolean_options + ['no-builtin', 'no_openmp']
@@ -37,17 +52,30 @@ class build(_build):
         _build.initialize_options(self)
         self.no_builtin = None
         self.no_openmp = None
+        self.variants = None
+        
+    def finalize_options(self):
+        _build.finalize_options(self)
+        variants = [v.strip() for v in (self.variants or 'portable,native,pgo').split(',') if v.strip()]
+        unknown = [v for v in variants if v not in ['portable','native','pgo']]
+        if unknown: raise DistutilsError("Unknown CAMB variants %s, expected portable, native, or pgo"%unknown)
+        #the portable variant is the default executable so it's always built
+        self.variants = ['portable'] + [v for v in variants if v!='portable']
+        
+        
+    def get_compiler_family(self, fcompiler):
+        """Get 'gnu' or 'intel', or None for other compilers."""
+        fc_name = {v:k for (k,(_,v,_)) in list(FC.fcompiler_class.items())}.get(fcompiler.__class__)
+        if fc_name is not None:
+            if fc_name.startswith('gnu'): return 'gnu'
+            elif fc_name.startswith('intel'): return 'intel'
+        return None
         
         
     def get_openmp_flags(self, fcompiler):
         """Hack to get OpenMP flags. Only gnu and intel will work, others are single threaded."""
         if not self.no_openmp:
-            fc_name = {v:k for (k,(_,v,_)) in list(FC.fcompiler_class.items())}.get(fcompiler.__class__)
-            if fc_name is not None:
-                if fc_name.startswith('gnu'):
-                    return ['-fopenmp']
-                elif fc_name.startswith('intel'):
-                    return ['-openmp']
+            return {'gnu':['-fopenmp'], 'intel':['-openmp']}.get(self.get_compiler_family(fcompiler),[])
         return []
         
         
@@ -84,6 +112,23 @@ class build(_build):
         localFile.close()
 
 
+    def make_server_driver(self, src_dir):
+        """
+        Turn CAMB's inidriver program into a subroutine taking the ini filename,
+        which camb4py_server.f90 can call repeatedly. Returns the new source file.
+        """
+        with open(os.path.join(src_dir,'inidriver.f90')) as f: src = f.read()
+        src, n = re.subn(r'(?im)^(\s*)program\s+\w+.*$', r'\1subroutine camb4py_driver(camb4py_input)', src, count=1)
+        if n!=1: raise DistutilsError("Couldn't find the main program in inidriver.f90")
+        src = re.sub(r'(?im)^(\s*)end\s+program\b.*$', r'\1end subroutine camb4py_driver', src)
+        src = re.sub(r'(?im)^(\s*)implicit\s+none\b.*$', r'\g<0>\n\1character(LEN=*), intent(in) :: camb4py_input', src, count=1)
+        src = re.sub(r'(?i)GetParamCount\s*\(\s*\)', '1', src)
+        src = re.sub(r'(?i)GetParam\s*\(\s*1\s*\)', 'camb4py_input', src)
+        driver = os.path.join(src_dir,'camb4py_driver.f90')
+        with open(driver,'w') as f: f.write(src)
+        return driver
+
+
     def run(self):
         """ Modified to compile CAMB. """
         
@@ -103,26 +148,97 @@ class build(_build):
             for f in os.listdir(src_dir):
                 if 'F90' in f: os.rename(os.path.join(src_dir,f), os.path.join(src_dir,f.replace('F90','f90')))
 
+            #an index of the parameters CAMB reads, which calls are checked against
+            from camb4py.camb4py import get_valid_params
+            with open(os.path.join(self.build_lib,'camb4py','camb_keys.json'),'w') as f: 
+                json.dump(get_valid_params(src_dir), f, indent=1, sort_keys=True)
+
             templ = os.path.join(src_dir,'HighLExtrapTemplate_lenspotentialCls.dat')
             if os.path.exists(templ): 
                 self.copy_file(templ, os.path.join(self.build_lib,'camb4py'))
     
     
-            openmp_flags = self.get_openmp_flags(fcompiler)
-            compile_flags = openmp_flags + ['-cpp']
-            if fcompiler.module_dir_switch is not None: 
-                compile_flags += [fcompiler.module_dir_switch+src_dir]
-            link_flags = openmp_flags
+            for variant in self.variants:
+                try:
+                    self.build_variant(fcompiler, src_dir, variant)
+                except (DistutilsError, CCompilerError, subprocess.CalledProcessError) as e:
+                    if variant=='portable': raise
+                    print("Warning: couldn't build the %s variant of CAMB, variant='%s' won't be available.\n%s"%(variant,variant,e))
+
+
+    def build_variant(self, fcompiler, src_dir, variant):
+        """
+        Build the camb and camb_server executables of one variant, named e.g. camb_native 
+        and camb_server_native, except for the portable variant which are just camb and camb_server.
+        """
+        family = self.get_compiler_family(fcompiler)
+        flags = self.variant_flags.get(family,{}).get(variant, [] if variant=='portable' else None)
+        if flags is None: raise DistutilsError("Don't know the flags for the %s variant with this compiler."%variant)
+        suffix = '' if variant=='portable' else '_'+variant
+        obj_dir = os.path.join(self.build_temp, variant)
+        
+        if variant=='pgo':
+            profile_dir = os.path.abspath(os.path.join(self.build_temp,'pgo_profile'))
+            generate, use = self.pgo_flags[family]
+            instrumented = self.build_executables(fcompiler, src_dir, obj_dir, flags + [f.replace('%s',profile_dir) for f in generate], 
+                                                  '_pgo_instrumented', server=False)
+            try:
+                self.train_pgo(instrumented)
+            finally:
+                os.remove(instrumented)
+            flags = flags + [f.replace('%s',profile_dir) for f in use]
             
-            obj_files = fcompiler.compile([os.path.join(src_dir,'%s.f90'%o) for o in self.objs],
-                                           extra_postargs=compile_flags,)
-#                                           output_dir=self.build_temp)
-                
-            fcompiler.link_executable(obj_files,
-                                      'camb',
-                                      output_dir=os.path.join(self.build_lib,'camb4py'),
-                                      extra_postargs=link_flags)
+        self.build_executables(fcompiler, src_dir, obj_dir, flags, suffix)
+        
+        
+    def build_executables(self, fcompiler, src_dir, obj_dir, flags, suffix, server=True):
+        """Compile CAMB (and the server, if possible) with the given flags, and return the path of the camb executable."""
+        if not os.path.exists(obj_dir): os.makedirs(obj_dir)
+        openmp_flags = self.get_openmp_flags(fcompiler)
+        compile_flags = openmp_flags + flags + ['-cpp']
+        if fcompiler.module_dir_switch is not None: 
+            compile_flags += [fcompiler.module_dir_switch+obj_dir]
+        link_flags = openmp_flags + flags
+        output_dir = os.path.join(self.build_lib,'camb4py')
+        
+        obj_files = fcompiler.compile([os.path.join(src_dir,'%s.f90'%o) for o in self.objs],
+                                      output_dir=obj_dir,
+                                      extra_postargs=compile_flags)
+            
+        fcompiler.link_executable(obj_files,
+                                  'camb'+suffix,
+                                  output_dir=output_dir,
+                                  extra_postargs=link_flags)
+        
+        if server:
+            try:
+                server_src = os.path.join(src_dir,'camb4py_server.f90')
+                self.copy_file(os.path.join('camb4py','src','camb4py_server.f90'), server_src)
+                server_objs = fcompiler.compile([self.make_server_driver(src_dir), server_src],
+                                                output_dir=obj_dir,
+                                                extra_postargs=compile_flags)
+                fcompiler.link_executable(obj_files[:-1] + server_objs,
+                                          'camb_server'+suffix,
+                                          output_dir=output_dir,
+                                          extra_postargs=link_flags)
+            except DistutilsError as e:
+                print("Warning: couldn't build the CAMB server, protocol='server' won't be available.\n%s"%e)
+            
+        return os.path.join(output_dir,'camb'+suffix)
+
 
+    def train_pgo(self, executable):
+        """Run an instrumented CAMB on the pgo_training models, so it records the profile used to build the pgo variant."""
+        from camb4py.camb4py import _default_params, try_bool2str
+        train_dir = os.path.abspath(os.path.join(self.build_temp,'pgo_train'))
+        if not os.path.exists(train_dir): os.makedirs(train_dir)
+        for i,params in enumerate(self.pgo_training):
+            p = dict(_default_params, output_root=os.path.join(train_dir,'model%i'%i), **params)
+            ini = os.path.join(train_dir,'model%i.ini'%i)
+            with open(ini,'w') as f: 
+                f.write('\n'.join(['%s = %s'%(k,try_bool2str(v)) for k,v in p.items()]+['END','']))
+            print("Training the pgo variant of CAMB with %s"%params)
+            subprocess.check_call(['./%s'%os.path.basename(executable), ini], cwd=os.path.dirname(executable))
         
         
 setup(